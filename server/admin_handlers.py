@@ -9,7 +9,8 @@ from tornado_utils.routes import route
 import motor
 
 from handlers import BaseHandler, TileMakerMixin
-from utils import count_all_tiles, find_original
+from utils import find_original, get_tile_grid, rebuild_manifest
+import manifest
 import settings
 
 
@@ -30,19 +31,13 @@ class AdminBaseHandler(BaseHandler):
         return user in settings.ADMIN_EMAILS
 
     def _count_tiles(self, image):
-        count_key = 'count_all_tiles:%s' % image['fileid']
-        count = self.redis.get(count_key)
-        if count is None:
-            count = count_all_tiles(
+        if not manifest.has_manifest(self.redis, image['fileid']):
+            # tiles made before there were manifests
+            return rebuild_manifest(
                 image['fileid'],
                 self.application.settings['static_path']
             )
-            self.redis.setex(
-                count_key,
-                count,
-                60 * 5
-            )
-        return count
+        return manifest.count_tiles(self.redis, image['fileid'])
 
     def _calculate_ranges(self, image):
         ranges = []
@@ -66,9 +61,7 @@ class AdminBaseHandler(BaseHandler):
     def _expected_tiles(self, image):
         count = 0
         for zoom in image['ranges']:
-            extra = self.get_extra_rows_cols(zoom)
-            width = 256 * (2 ** zoom)
-            cols = rows = extra + width / 256
+            rows, cols = get_tile_grid(image['width'], image['height'], zoom)
             count += (cols * rows)
         return count
 
@@ -267,13 +260,6 @@ class AdminTilesHandler(AdminBaseHandler):
             fileid[3:]
         )
 
-        if image['contenttype'] == 'image/jpeg':
-            extension = 'jpg'
-        elif image['contenttype'] == 'image/png':
-            extension = 'png'
-        else:
-            raise NotImplementedError
-
         image['found_tiles'] = self._count_tiles(image)
         _ranges = image.get('ranges')
         if _ranges:
@@ -281,7 +267,8 @@ class AdminTilesHandler(AdminBaseHandler):
         image['ranges'] = _ranges or self._calculate_ranges(image)
         image['expected_tiles'] = self._expected_tiles(image)
         _tiles_before = self.get_argument('before', None)
-        if _tiles_before is not None and _tiles_before != image['found_tiles']:
+        if (_tiles_before is not None and
+                _tiles_before != str(image['found_tiles'])):
             if image.get('cdn_domain'):
                 yield motor.Op(
                     self.db.images.update,
@@ -302,26 +289,17 @@ class AdminTilesHandler(AdminBaseHandler):
         _cols = {}
         _rows = {}
         tiles = {}
-        root = self.application.settings['static_path']
         for zoom in image['ranges']:
-            extra = self.get_extra_rows_cols(zoom)
-            tiles[zoom] = {}
-            width = 256 * (2 ** zoom)
-            cols = rows = extra + width / 256
+            rows, cols = get_tile_grid(image['width'], image['height'], zoom)
             _cols[zoom] = cols
             _rows[zoom] = rows
-            for row in range(rows):
-                for col in range(cols):
-                    key = '%s,%s' % (row, col)
-                    filename = os.path.join(
-                        root,
-                        'tiles',
-                        image_split,
-                        '256',
-                        str(zoom),
-                        key + '.' + extension
-                    )
-                    tiles[zoom][key] = os.path.isfile(filename)
+            tiles[zoom] = manifest.get_tiles(
+                self.redis,
+                fileid,
+                zoom,
+                rows,
+                cols
+            )
         data['rows'] = _rows
         data['cols'] = _cols
         data['tiles'] = tiles
@@ -358,7 +336,7 @@ class AdminPrepareAllTilesHandler(AdminBaseHandler, TileMakerMixin):
             _ranges = [int(x) for x in _ranges]
         ranges = _ranges or self._calculate_ranges(image)
 
-        extension = destination.split('.')[-1]
+        extension, profile = self.get_tile_format(image)
 
         had_to_give_up = yield tornado.gen.Task(
             self.prepare_all_tiles,
@@ -366,11 +344,11 @@ class AdminPrepareAllTilesHandler(AdminBaseHandler, TileMakerMixin):
             destination,
             ranges,
             extension,
+            profile,
+            image['width'],
+            image['height'],
         )
 
-        count_key = 'count_all_tiles:%s' % image['fileid']
-        self.redis.delete(count_key)
-
         url = self.reverse_url('admin_tiles', fileid)
         data = {
             'before': str(count_before),
@@ -544,18 +522,11 @@ class AdminResendEmailHandler(AdminBaseHandler, TileMakerMixin):
             email,
         )
 
-        delay = 1
-        total_delay = 0
-        ioloop_instance = tornado.ioloop.IOLoop.instance()
-        while job.result is None:
-            yield tornado.gen.Task(
-                ioloop_instance.add_timeout,
-                time.time() + delay
-            )
-            delay += 1
-            total_delay += delay
-            if total_delay > 3:
-                break
+        yield tornado.gen.Task(
+            self.application.job_waiter.wait,
+            job.channel,
+            3
+        )
 
         url = self.reverse_url('admin_image', fileid)
         self.redirect(url)
@@ -3,6 +3,7 @@
 import os
 import re
 import logging
+import functools
 from time import sleep
 import tornado.httpserver
 import tornado.ioloop
@@ -14,6 +15,7 @@ import motor
 import settings
 import handlers
 import admin_handlers
+from jobs import JobWaiter, Batcher
 
 
 define("debug", default=False, help="run in debug mode", type=bool)
@@ -37,6 +39,29 @@ class Application(tornado.web.Application):
             )
         return self._redis
 
+    _job_waiter = None
+
+    @property
+    def job_waiter(self):
+        if not self._job_waiter:
+            self._job_waiter = JobWaiter(
+                self.redis,
+                tornado.ioloop.IOLoop.instance()
+            )
+        return self._job_waiter
+
+    _tile_batcher = None
+
+    @property
+    def tile_batcher(self):
+        if not self._tile_batcher:
+            self._tile_batcher = Batcher(
+                tornado.ioloop.IOLoop.instance(),
+                settings.TILE_BATCH_WINDOW,
+                functools.partial(handlers.enqueue_tile_batch, self.redis)
+            )
+        return self._tile_batcher
+
     _db_connection = None
 
     @property
@@ -0,0 +1,95 @@
+import os
+import sys
+import errno
+import fcntl
+from contextlib import contextmanager
+
+# temporary and lock files start with a dot so that globs and directory
+# walks looking for tiles, thumbnails and resizes skip them
+TEMPORARY_PREFIX = '.tmp-'
+LOCK_PREFIX = '.lock-'
+
+
+def is_hidden(path):
+    return os.path.basename(path).startswith('.')
+
+
+def temporary_path(path):
+    """return a path in the same directory as `path`, so it can be
+    renamed onto it, that ends the same way so tools that look at the
+    file extension still know what format to write."""
+    head, tail = os.path.split(path)
+    return os.path.join(
+        head,
+        '%s%s-%s' % (TEMPORARY_PREFIX, os.getpid(), tail)
+    )
+
+
+@contextmanager
+def path_lock(path):
+    """hold an exclusive lock on `path` across processes, waiting for
+    whoever else has it to finish first."""
+    head, tail = os.path.split(path)
+    lock_path = os.path.join(head, LOCK_PREFIX + tail)
+    while True:
+        fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # whoever had it before us might have removed the lock file,
+            # and somebody else locked a new one, while we were waiting
+            try:
+                locked = os.fstat(fd).st_ino == os.stat(lock_path).st_ino
+            except OSError as exception:
+                if exception.errno != errno.ENOENT:
+                    raise
+                locked = False
+        except:
+            os.close(fd)
+            raise
+        if locked:
+            break
+        os.close(fd)
+    try:
+        yield
+    finally:
+        # still holding the lock so anybody waiting on this lock file
+        # sees it's gone and locks a new one
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+        os.close(fd)
+
+
+def write_atomically(path, writer):
+    """call `writer` with a temporary path and when it's done rename that
+    onto `path` so nobody ever sees a half written file."""
+    tmp = temporary_path(path)
+    try:
+        writer(tmp)
+        os.rename(tmp, path)
+    except:
+        # keep the writer's exception, in python 2 a bare raise would
+        # re-raise the last one caught below
+        exc_info = sys.exc_info()
+        try:
+            os.remove(tmp)
+        except OSError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return path
+
+
+def create_once(path, writer):
+    """make `path` with `writer` unless it already exists.
+
+    If another process is busy making the same path this waits for it to
+    finish instead of making it again.
+    """
+    if os.path.isfile(path):
+        return path
+    with path_lock(path):
+        if not os.path.isfile(path):
+            write_atomically(path, writer)
+    return path
@@ -15,6 +15,7 @@ from tornado.ioloop import IOLoop
 import redis.client
 import settings
 from utils import find_all_tiles, find_original
+from tilestore import find_all_blanks, get_blank_path, read_tile
 
 
 def upload_original(fileid, extension, static_path, bucket_id):
@@ -90,6 +91,11 @@ def upload_all_tiles(fileid, static_path, bucket_id, max_count=0,
             if each not in done:
                 done.append(each)
                 relative_path = each.replace(static_path, '')
+                if (relative_path.startswith('/objects/') and
+                        bucket.get_key(relative_path)):
+                    # another image with the same tile uploaded it
+                    open(log_file, 'a').write(each + '\n')
+                    continue
                 k = Key(bucket)
                 k.key = relative_path
                 # docs:
@@ -101,12 +107,21 @@ def upload_all_tiles(fileid, static_path, bucket_id, max_count=0,
                 except IOError:
                     count_done = []
                 print "(%d of %d)" % (len(count_done), total)
-                k.set_contents_from_filename(
-                    each,
-                    replace=replace,
-                    reduced_redundancy=True,
-                    headers=aggressive_headers,
-                )
+                if os.path.isfile(each):
+                    k.set_contents_from_filename(
+                        each,
+                        replace=replace,
+                        reduced_redundancy=True,
+                        headers=aggressive_headers,
+                    )
+                else:
+                    # a packed tile
+                    k.set_contents_from_string(
+                        read_tile(each, static_path, 256),
+                        replace=replace,
+                        reduced_redundancy=True,
+                        headers=aggressive_headers,
+                    )
                 k.make_public()
                 open(log_file, 'a').write(each + '\n')
                 count += 1
@@ -116,6 +131,7 @@ def upload_all_tiles(fileid, static_path, bucket_id, max_count=0,
                     break
 
         if all_done:
+            upload_blanks(fileid, static_path, bucket, aggressive_headers)
             data = {'cdn_domain': settings.DEFAULT_CDN_TILER_DOMAIN}
             print "Updating document finally"
             yield motor.Op(
@@ -143,6 +159,28 @@ def upload_all_tiles(fileid, static_path, bucket_id, max_count=0,
         IOLoop.instance().stop()
 
 
+def upload_blanks(fileid, static_path, bucket, headers):
+    """the tiles that are all one colour aren't uploaded, instead the
+    shared blank tile they use is uploaded once for every image"""
+    names = set()
+    for blanks in find_all_blanks(fileid, static_path).values():
+        names.update(blanks.values())
+    for name in names:
+        path = get_blank_path(static_path, 256, name)
+        relative_path = path.replace(static_path, '')
+        if bucket.get_key(relative_path):
+            continue
+        print "uploading blank", relative_path
+        k = Key(bucket)
+        k.key = relative_path
+        k.set_contents_from_filename(
+            path,
+            reduced_redundancy=True,
+            headers=headers,
+        )
+        k.make_public()
+
+
 def get_aggressive_headers(years=2):
     cache_control = 'max-age=%d, public' % (3600 * 24 * 360 * years)
     _delta = datetime.timedelta(days=365 * years)
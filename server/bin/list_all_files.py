@@ -7,6 +7,7 @@ sys.path.insert(
 )
 
 from utils import find_all_tiles
+from tilestore import tile_exists
 
 
 def run(fileids):
@@ -14,7 +15,7 @@ def run(fileids):
     for fileid in fileids:
         for each in find_all_tiles(fileid, static_path):
             print each
-            assert os.path.isfile(each), each
+            assert os.path.isfile(each) or tile_exists(each), each
 
 
 if __name__ == '__main__':
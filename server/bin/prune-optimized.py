@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+
+import os, sys
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), '..')
+)
+
+import settings
+from optimizer import get_cache_root, prune_cache
+
+
+def run():
+    static_path = os.path.join(os.path.abspath(os.curdir), 'static')
+    cache_root = get_cache_root(static_path)
+    if not cache_root:
+        print "OPTIMIZE_CACHE is off"
+        return
+    freed = prune_cache(cache_root, settings.OPTIMIZE_CACHE_MAX_AGE)
+    print "Freed %.1fKb" % (freed / 1000.0)
+
+
+if __name__ == '__main__':
+    run()
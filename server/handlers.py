@@ -9,6 +9,8 @@ import logging
 import hashlib
 import time
 import datetime
+import email.utils
+from cStringIO import StringIO
 from pprint import pprint
 
 from bson.objectid import ObjectId
@@ -23,13 +25,21 @@ from tornado_utils.timesince import smartertimesince
 from rq import Queue
 import motor
 from utils import (
-    mkdir, make_tile, make_tiles, make_thumbnail, delete_image,
-    count_all_tiles
+    mkdir, make_tiles, make_thumbnail, delete_image,
+    get_tile_grid, rebuild_manifest, make_neighbourhood, make_tile_batch
 )
+from tilestore import (
+    find_tile, find_all_aliases, get_blank_path, get_object_path, read_tile,
+    get_tile_size, tile_exists, get_tile_version, find_blank
+)
+import manifest
 from optimizer import optimize_images, optimize_thumbnails
 from awsuploader import upload_tiles, upload_original
 from resizer import make_resize
+from pyramid import make_pyramid
+from tileformat import record_tile_format, get_tile_format
 from emailer import send_url
+from jobs import enqueue, new_channel
 import settings
 
 
@@ -38,6 +48,23 @@ def sample_queue_job():
     return "OK"
 
 
+def enqueue_tile_batch(redis_, key, tiles):
+    """enqueue one job for all the tiles TileHandler collected for the
+    same image and zoom level"""
+    image, size, zoom, extension, static_path, profile = key
+    q = Queue(connection=redis_)
+    q.enqueue(
+        make_tile_batch,
+        image,
+        size,
+        zoom,
+        tiles,
+        extension,
+        static_path,
+        profile=profile
+    )
+
+
 class BaseHandler(tornado.web.RequestHandler):
 
     DEFAULT_RANGE_MIN = 2
@@ -62,6 +89,47 @@ class BaseHandler(tornado.web.RequestHandler):
     def get_current_user(self):
         return self.get_secure_cookie('user')
 
+    def set_cache_headers(self, cache_seconds):
+        self.set_header(
+            'Cache-Control',
+            'max-age=%d, public' % cache_seconds
+        )
+        if cache_seconds > 3600:
+            _expires = (
+                datetime.datetime.utcnow() +
+                datetime.timedelta(seconds=cache_seconds)
+            )
+            self.set_header(
+                'Expires',
+                _expires.strftime('%a, %d %b %Y %H:%M:%S GMT')
+            )
+
+    def check_not_modified(self, etag, last_modified):
+        """set the ETag and Last-Modified headers and return True, having
+        set the status to 304, if the browser already has this version"""
+        etag = '"%s"' % etag
+        modified = datetime.datetime.utcfromtimestamp(int(last_modified))
+        self.set_header('Etag', etag)
+        self.set_header(
+            'Last-Modified',
+            modified.strftime('%a, %d %b %Y %H:%M:%S GMT')
+        )
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match:
+            not_modified = if_none_match.find(etag) != -1
+        else:
+            not_modified = False
+            if_since = self.request.headers.get('If-Modified-Since')
+            if if_since:
+                date_tuple = email.utils.parsedate(if_since)
+                if date_tuple:
+                    not_modified = (
+                        datetime.datetime(*date_tuple[:6]) >= modified
+                    )
+        if not_modified:
+            self.set_status(304)
+        return not_modified
+
     def render(self, template, **options):
         options['user'] = self.get_current_user()
         options['debug'] = self.application.settings['debug']
@@ -146,11 +214,6 @@ class BaseHandler(tornado.web.RequestHandler):
         cache_keys_key = 'thumbnail_grid:keys'
         self.redis.lpush(cache_keys_key, key)
 
-    def get_extra_rows_cols(self, zoom):
-        if zoom == 2:
-            return 0
-        return 1  # default
-
     def make_destination(self, fileid, content_type=None):
         root = os.path.join(
             self.application.settings['static_path'],
@@ -178,6 +241,18 @@ class BaseHandler(tornado.web.RequestHandler):
 
         return destination
 
+    def get_tile_format(self, document):
+        """return the (extension, encode profile) of the image's tiles,
+        the profile being None for TILE_ENCODE_PROFILE"""
+        if document.get('tile_extension'):
+            return document['tile_extension'], document.get('tile_profile')
+        # picked before there was a choice
+        if document['contenttype'] == 'image/jpeg':
+            return 'jpg', None
+        if document['contenttype'] == 'image/png':
+            return 'png', None
+        return self.DEFAULT_EXTENSION, None
+
 
 class ThumbnailGridRendererMixin(object):
 
@@ -434,6 +509,12 @@ class ImageHandler(BaseHandler):
         if metadata and 'date_timestamp' not in metadata:
             # legacy
             metadata = None
+        if metadata and 'height' not in metadata:
+            # legacy
+            metadata = None
+        if metadata and 'tile_extension' not in metadata:
+            # legacy
+            metadata = None
 
         if metadata is not None:
             metadata = json.loads(metadata)
@@ -443,6 +524,7 @@ class ImageHandler(BaseHandler):
             date_timestamp = metadata['date_timestamp']
             width = metadata['width']
             cdn_domain = metadata.get('cdn_domain')
+            tile_extension = metadata['tile_extension']
 
         else:
             logging.info("Meta data cache miss (%s)" % fileid)
@@ -457,8 +539,10 @@ class ImageHandler(BaseHandler):
             owner = document['user']
             title = document.get('title', '')
             width = document['width']
+            height = document['height']
             cdn_domain = document.get('cdn_domain', None)
             date_timestamp = time.mktime(document['date'].timetuple())
+            tile_extension, tile_profile = self.get_tile_format(document)
 
             metadata = {
                 'content_type': content_type,
@@ -466,7 +550,10 @@ class ImageHandler(BaseHandler):
                 'title': title,
                 'date_timestamp': date_timestamp,
                 'width': width,
+                'height': height,
                 'cdn_domain': cdn_domain,
+                'tile_extension': tile_extension,
+                'tile_profile': tile_profile,
             }
             if document.get('ranges'):
                 metadata['ranges'] = document['ranges']
@@ -497,13 +584,13 @@ class ImageHandler(BaseHandler):
         can_comment = not embedded
 
         if content_type == 'image/jpeg':
-            extension = 'jpg'
+            original_extension = 'jpg'
         elif content_type == 'image/png':
-            extension = 'png'
+            original_extension = 'png'
         else:
             print "Guessing extension :("
-            extension = self.DEFAULT_EXTENSION
-        extension = self.get_argument('extension', extension)
+            original_extension = self.DEFAULT_EXTENSION
+        extension = self.get_argument('extension', tile_extension)
         assert extension in ('png', 'jpg'), extension
 
         if age > 60 * 60 and not cdn_domain:
@@ -511,12 +598,21 @@ class ImageHandler(BaseHandler):
             lock_key = 'uploading:%s' % fileid
             if self.redis.get(lock_key):
                 print "AWS uploading is locked"
+            elif not manifest.has_manifest(self.redis, fileid):
+                # tiles made before there were manifests, only once until
+                # it's done or the lock expires
+                rebuild_key = 'rebuilding:%s' % fileid
+                if self.redis.setnx(rebuild_key, time.time()):
+                    self.redis.expire(rebuild_key, 60 * 60)
+                    q = Queue(connection=self.redis)
+                    q.enqueue(
+                        rebuild_manifest,
+                        fileid,
+                        self.application.settings['static_path']
+                    )
             else:
                 # we're ready to upload it
-                _no_tiles = count_all_tiles(
-                    fileid,
-                    self.application.settings['static_path']
-                )
+                _no_tiles = manifest.count_tiles(self.redis, fileid)
                 self.redis.setex(lock_key, time.time(), 60 * 60)
                 q = Queue(connection=self.redis)
                 logging.info("About to upload %s tiles" % _no_tiles)
@@ -533,7 +629,7 @@ class ImageHandler(BaseHandler):
                 q.enqueue(
                     upload_original,
                     fileid,
-                    extension,
+                    original_extension,
                     self.application.settings['static_path'],
                     settings.ORIGINALS_BUCKET_ID
                 )
@@ -545,7 +641,7 @@ class ImageHandler(BaseHandler):
             og_image_url = self.make_thumbnail_url(
                 fileid,
                 100,
-                extension=extension,
+                extension=original_extension,
                 absolute_url=True,
             )
 
@@ -554,6 +650,13 @@ class ImageHandler(BaseHandler):
         else:
             default_location = None
 
+        # tiles that are shared blanks aren't under their own URL so the
+        # map has to be told where to get them from instead
+        aliases = find_all_aliases(
+            fileid,
+            self.application.settings['static_path']
+        )
+
         self.render(
             'image.html',
             fileid=fileid,
@@ -571,6 +674,7 @@ class ImageHandler(BaseHandler):
             hide_annotations=hide_annotations,
             hide_download_counter=hide_download_counter,
             default_location=default_location,
+            aliases=aliases,
         )
 
 
@@ -622,9 +726,12 @@ class ImageWeightCounterHandler(BaseHandler):
         )
         bytes = 0
         for each in urls.split('|'):
-            path = os.path.join(root, each + extension)
             try:
-                bytes += os.stat(path)[stat.ST_SIZE]
+                bytes += get_tile_size(
+                    os.path.join(root, each + extension),
+                    self.settings['static_path'],
+                    256
+                ) or 0
             except OSError:
                 pass
         if bytes:
@@ -1213,92 +1320,126 @@ class TileMakerMixin(object):
 
     @tornado.gen.engine
     def prepare_all_tiles(self, fileid, original, ranges, extension,
-                          callback):
+                          profile, width, height, callback):
         had_to_give_up = False
         image_split = fileid[:1] + '/' + fileid[1:3] + '/' + fileid[3:]
 
         q = Queue(connection=self.redis)
         jobs = []
 
+        grids = {}
         for zoom in ranges:
-            jobs.append(q.enqueue(
-                make_resize,
-                original,
-                zoom
-            ))
-
-            extra = self.get_extra_rows_cols(zoom)
-            width = 256 * (2 ** zoom)
-            cols = rows = extra + width / 256
+            grids[zoom] = get_tile_grid(width, height, zoom)
 
-            jobs.append(q.enqueue(
-                make_tiles,
+        if settings.TILING_ENGINE == 'pyramid':
+            # one job that decodes the image once for all zoom levels
+            jobs.append(enqueue(
+                q,
+                make_pyramid,
                 image_split,
                 256,
-                zoom,
-                rows,
-                cols,
+                ranges,
+                grids,
                 extension,
                 self.application.settings['static_path'],
+                resize_engine=settings.RESIZE_ENGINE,
+                profile=profile,
             ))
+        else:
+            options = {}
+            if settings.TILING_ENGINE == 'strip':
+                options['memory_budget'] = settings.TILING_MEMORY_BUDGET
+            elif settings.TILING_ENGINE == 'parallel':
+                options['processes'] = settings.TILING_PROCESSES
+            for zoom in ranges:
+                if settings.RESIZE_CASCADE:
+                    # make_tiles() makes this zoom level's resize from
+                    # the one above it first
+                    options['cascade'] = [x for x in ranges if x > zoom]
+                    options['resize_engine'] = settings.RESIZE_ENGINE
+                else:
+                    jobs.append(enqueue(
+                        q,
+                        make_resize,
+                        original,
+                        zoom,
+                        memory_limit=options.get('memory_budget'),
+                        engine=settings.RESIZE_ENGINE,
+                    ))
+
+                rows, cols = grids[zoom]
+                jobs.append(enqueue(
+                    q,
+                    make_tiles,
+                    image_split,
+                    256,
+                    zoom,
+                    rows,
+                    cols,
+                    extension,
+                    self.application.settings['static_path'],
+                    profile=profile,
+                    **options
+                ))
 
-        jobs.append(q.enqueue(
+        # the thumbnails are in the format of the original whatever
+        # the tiles are in
+        original_extension = original.split('.')[-1]
+        jobs.append(enqueue(
+            q,
             make_thumbnail,
             image_split,
             100,
-            extension,
+            original_extension,
             self.application.settings['static_path'],
+            resize_engine=settings.RESIZE_ENGINE,
         ))
 
         for zoom in ranges:
-            jobs.append(q.enqueue(
+            jobs.append(enqueue(
+                q,
                 optimize_images,
                 image_split,
                 zoom,
                 extension,
                 self.application.settings['static_path'],
+                profile=profile,
             ))
 
-        jobs.append(q.enqueue(
+        jobs.append(enqueue(
+            q,
             optimize_thumbnails,
             image_split,
-            extension,
+            original_extension,
             self.application.settings['static_path'],
         ))
 
         lock_key = 'uploading:%s' % fileid
         self.redis.setex(lock_key, time.time(), 60 * 60)
 
-        ioloop_instance = tornado.ioloop.IOLoop.instance()
-        delay = 1
-        total_delay = 0
-        while True:
-            #print "TOTAL DELAY", total_delay
-            yield tornado.gen.Task(
-                ioloop_instance.add_timeout,
-                time.time() + delay
-            )
-            delay += 5
-            total_delay += delay
-
-            jobs_done = len([
-                x for x in jobs
-                if x.result is not None
-            ])
-            jobs_remaining = [
-                x for x in jobs
-                if x.result is None
-            ]
-            #print "jobs_remaining", len(jobs_remaining)
-            if not jobs_remaining:
+        # wait for them in the order they were enqueued, which is roughly
+        # the order they'll get done in
+        deadline = time.time() + 50
+        jobs_done = 0
+        for job in jobs:
+            remaining = deadline - time.time()
+            if remaining <= 0:
                 break
-            if total_delay > 50:
-                # if at least 2 jobs had been done,
-                # it means the resizing and and tiles were made for
-                # the default zoom level.
-                # and it's a healthy sign it managed to do one more
-                had_to_give_up = jobs_done > 2
+            status = yield tornado.gen.Task(
+                self.application.job_waiter.wait,
+                job.channel,
+                remaining
+            )
+            if not status:
                 break
+            if status == 'done':
+                jobs_done += 1
+        if jobs_done < len(jobs):
+            # if at least 2 jobs had been done,
+            # it means the resizing and and tiles were made for
+            # the default zoom level.
+            # and it's a healthy sign it managed to do one more
+            had_to_give_up = jobs_done > 2
 
         callback(had_to_give_up)
 
@@ -1326,7 +1467,8 @@ class TileMakerMixin(object):
         )
 
         q = Queue(connection=self.redis)
-        job = q.enqueue(
+        job = enqueue(
+            q,
             send_url,
             url,
             fileid,
@@ -1387,6 +1529,32 @@ class DownloadUploadHandler(UploadHandler, TileMakerMixin):
             data = {'width': size[0], 'height': size[1]}
             if not document.get('size'):
                 data['size'] = os.stat(destination)[stat.ST_SIZE]
+            if settings.TILE_FORMAT == 'auto':
+                # it has to resize the original so it's a job
+                options = {}
+                if settings.TILING_ENGINE == 'strip':
+                    options['memory_limit'] = settings.TILING_MEMORY_BUDGET
+                job = enqueue(
+                    Queue(connection=self.redis),
+                    record_tile_format,
+                    fileid,
+                    destination,
+                    self.DEFAULT_RANGE_MIN,
+                    resize_engine=settings.RESIZE_ENGINE,
+                    **options
+                )
+                yield tornado.gen.Task(
+                    self.application.job_waiter.wait,
+                    job.channel,
+                    10
+                )
+                tile_format = get_tile_format(self.redis, fileid)
+                if tile_format:
+                    data['tile_extension'], data['tile_profile'] = tile_format
+                else:
+                    logging.warning("Unable to choose the tile format of %r"
+                                    % fileid)
+            extension, profile = self.get_tile_format(dict(document, **data))
             yield motor.Op(
                 self.db.images.update,
                 {'_id': document['_id']},
@@ -1423,7 +1591,6 @@ class DownloadUploadHandler(UploadHandler, TileMakerMixin):
             # prepared first
             ranges.remove(self.DEFAULT_ZOOM)
             ranges.insert(0, self.DEFAULT_ZOOM)
-            extension = destination.split('.')[-1]
 
             #tiles_made = yield tornado.gen.Task(
             had_to_give_up = yield tornado.gen.Task(
@@ -1432,6 +1599,9 @@ class DownloadUploadHandler(UploadHandler, TileMakerMixin):
                 destination,
                 ranges,
                 extension,
+                profile,
+                size[0],
+                size[1],
             )
             # clear the home page cache
             try:
@@ -1455,7 +1625,7 @@ class DownloadUploadHandler(UploadHandler, TileMakerMixin):
             yield tornado.gen.Task(
                 self.email_about_upload,
                 fileid,
-                extension,
+                destination.split('.')[-1],
                 document['user'],
             )
         else:
@@ -1532,6 +1702,12 @@ class TileHandler(BaseHandler):
     to S3.
     """
 
+    # how long to wait for a tile that has to be made before giving up
+    # and serving the broken tile
+    WAIT_SECONDS = 10
+    # what's served for tiles outside the image
+    OUT_OF_BOUNDS_BLANK = 'rgba-00000000.png'
+
     @tornado.web.asynchronous
     @tornado.gen.engine
     def get(self, image, size, zoom, row, col, extension):
@@ -1543,72 +1719,290 @@ class TileHandler(BaseHandler):
         if size != 256:
             raise tornado.web.HTTPError(400, 'size must be 256')
 
-        q = Queue(connection=self.redis)
-        job = q.enqueue(
-            make_tile,
+        static_path = self.application.settings['static_path']
+        tile_filepath = os.path.join(
+            static_path,
+            'tiles',
             image,
-            size,
+            str(size),
             zoom,
-            row,
-            col,
-            extension,
-            self.application.settings['static_path']
+            '%s,%s.%s' % (row, col, extension)
         )
-        ioloop_instance = tornado.ioloop.IOLoop.instance()
-        delay = 0.1
-        while True:
-            yield tornado.gen.Task(
-                ioloop_instance.add_timeout,
-                time.time() + delay
+        if self._is_out_of_bounds(image, int(zoom), int(row), int(col)):
+            # Leaflet asks for these when panning past the edges
+            blank_filepath = get_blank_path(
+                static_path,
+                size,
+                self.OUT_OF_BOUNDS_BLANK
             )
-            delay *= 2
-            if job.result is not None:
-                save_filepath = job.result
-                break
+            self.set_header('Content-Type', 'image/png')
+            self.set_cache_headers(60 * 60 * 24 * 360)
+            stat_ = os.stat(blank_filepath)
+            etag = '%x-%x' % (int(stat_.st_mtime), stat_.st_size)
+            if not self.check_not_modified(etag, stat_.st_mtime):
+                self.write(open(blank_filepath, 'rb').read())
+            self.finish()
+            return
+
+        if tile_exists(tile_filepath):
+            # the queue made it already, no need to ask it again
+            self._write_tile(image, tile_filepath, size)
+            self.finish()
+            return
+
+        channel = self._get_tile_channel(image, size, zoom, row, col,
+                                         extension)
+        overzoomed = self._get_overzoomed(image, size, int(zoom), int(row),
+                                          int(col), extension)
+        if overzoomed is not None:
+            # a blurry tile now is better than a spinner, the real one is
+            # being made and replaces it shortly
+            self.set_header('Cache-Control', 'max-age=30')
+            self.write(overzoomed)
+            self.finish()
+            return
+
+        status = yield tornado.gen.Task(
+            self.application.job_waiter.wait,
+            channel,
+            self.WAIT_SECONDS
+        )
+        # whoever asks next gets to try again
+        self.redis.delete(self._making_key(image, zoom, row, col, extension))
 
         try:
-            _cache_seconds = 60 * 60 * 24
+            if status != 'done':
+                # it failed or it's stuck, either way don't hang on to
+                # the connection
+                self.redis.incr('tile_failures:%s' % (status or 'timeout'))
+                logging.warning("make_tile %s for %s" %
+                                (status or 'timed out', tile_filepath))
+                raise IOError(tile_filepath)
+            self._write_tile(image, tile_filepath, size)
+        except IOError:
+            self.set_header('Content-Type', 'image/png')
             self.set_header(
                 'Cache-Control',
-                'max-age=%d, public' % _cache_seconds
+                'max-age=0'
             )
-            if _cache_seconds > 3600:
-                _expires = (
-                    datetime.datetime.utcnow() +
-                    datetime.timedelta(seconds=_cache_seconds)
-                )
-                self.set_header(
-                    'Expires',
-                    _expires.strftime('%a, %d %b %Y %H:%M:%S GMT')
-                )
-            self.write(open(save_filepath, 'rb').read())
-            fileid = image.replace('/', '')
+            broken_filepath = os.path.join(
+                static_path,
+                'images',
+                'broken.png'
+            )
+            self.write(open(broken_filepath, 'rb').read())
 
+        self.finish()
+
+    def _write_tile(self, image, tile_filepath, size):
+        static_path = self.application.settings['static_path']
+        version = get_tile_version(tile_filepath, static_path, size)
+        if version is None:
+            raise IOError(tile_filepath)
+        alias_filepath = find_tile(tile_filepath, static_path, size)
+        if alias_filepath and alias_filepath != tile_filepath:
+            # a shared blank or an object which never change
+            self.set_cache_headers(60 * 60 * 24 * 360)
+        else:
+            self.set_cache_headers(60 * 60 * 24)
+            fileid = image.replace('/', '')
             lock_key = 'uploading:%s' % fileid
             if not self.redis.get(lock_key):
                 q = Queue(connection=self.redis)
                 q.enqueue(
                     upload_tiles,
                     fileid,
-                    self.application.settings['static_path'],
+                    static_path,
                     max_count=10,
                     only_if_no_cdn_domain=True
                 )
+        if self.check_not_modified(*version):
+            return
+        data = read_tile(tile_filepath, static_path, size)
+        if data is None:
+            raise IOError(tile_filepath)
+        self.write(data)
 
-        except IOError:
-            self.set_header('Content-Type', 'image/png')
-            self.set_header(
-                'Cache-Control',
-                'max-age=0'
+    def _get_overzoomed(self, image, size, zoom, row, col, extension):
+        """return the bytes of a tile cut from the closest zoom level above
+        that has the tile covering it, scaled up, or None if none of them
+        have it"""
+        static_path = self.application.settings['static_path']
+        for zoom_out in range(1, min(zoom, 8) + 1):
+            parent_filepath = os.path.join(
+                static_path,
+                'tiles',
+                image,
+                str(size),
+                str(zoom - zoom_out),
+                '%s,%s.%s' % (row >> zoom_out, col >> zoom_out, extension)
             )
-            broken_filepath = os.path.join(
-                self.application.settings['static_path'],
-                'images',
-                'broken.png'
+            data = read_tile(parent_filepath, static_path, size)
+            if data is None:
+                continue
+            parent = Image.open(StringIO(data))
+            if parent.mode not in ('RGB', 'RGBA', 'L'):
+                parent = parent.convert('RGBA')
+            part = size >> zoom_out
+            left = (row % (1 << zoom_out)) * part
+            top = (col % (1 << zoom_out)) * part
+            tile = parent.crop((left, top, left + part, top + part))
+            tile = tile.resize((size, size), Image.BICUBIC)
+            if extension == 'jpg' and tile.mode == 'RGBA':
+                tile = tile.convert('RGB')
+            out = StringIO()
+            tile.save(out, extension == 'png' and 'PNG' or 'JPEG')
+            return out.getvalue()
+        return None
+
+    def _get_grids(self, image, *zooms):
+        """return a dict of zoom -> (rows, cols) for those of `zooms` that
+        the image has according to its cached metadata, or None if there's
+        no metadata to tell"""
+        metadata = self._get_metadata(image)
+        if not metadata or 'height' not in metadata:
+            # legacy
+            return None
+        ranges = [int(x) for x in metadata.get('ranges') or []]
+        return dict(
+            (zoom, get_tile_grid(metadata['width'], metadata['height'], zoom))
+            for zoom in zooms
+            if not ranges or zoom <= max(ranges)
+        )
+
+    def _get_metadata(self, image):
+        metadata = self.redis.get('metadata:%s' % image.replace('/', ''))
+        return metadata and json.loads(metadata) or None
+
+    def _get_profile(self, image, extension):
+        """return the encode profile picked for the image's tiles if they're
+        asked for in the format that was picked for them too. Otherwise, or
+        without cached metadata to tell, None for TILE_ENCODE_PROFILE."""
+        metadata = self._get_metadata(image)
+        if metadata and metadata.get('tile_extension') == extension:
+            return metadata.get('tile_profile')
+        return None
+
+    def _is_out_of_bounds(self, image, zoom, row, col):
+        """return True if the image's cached metadata says there's no such
+        tile. Without the metadata we can't tell so it's False."""
+        grids = self._get_grids(image, zoom)
+        if grids is None:
+            return False
+        if zoom not in grids:
+            return True
+        rows, cols = grids[zoom]
+        return row >= rows or col >= cols
+
+    def _prefetch(self, image, size, zoom, row, col, extension, profile):
+        """make the tiles the user is about to ask for next in one job,
+        unless one has already been started for this part of the image"""
+        if not settings.TILE_PREFETCH_RADIUS:
+            return
+        grids = self._get_grids(image, zoom, zoom + 1)
+        if not grids:
+            return
+        block = settings.TILE_PREFETCH_RADIUS * 2 + 1
+        key = 'prefetching:%s:%s:%s,%s' % (
+            image.replace('/', ''), zoom, row / block, col / block
+        )
+        if not self.redis.setnx(key, 1):
+            return
+        self.redis.expire(key, 60)
+        q = Queue(connection=self.redis)
+        q.enqueue(
+            make_neighbourhood,
+            image,
+            size,
+            zoom,
+            row,
+            col,
+            extension,
+            self.application.settings['static_path'],
+            grids,
+            radius=settings.TILE_PREFETCH_RADIUS,
+            children=settings.TILE_PREFETCH_CHILDREN,
+            profile=profile,
+        )
+
+    def _making_key(self, image, zoom, row, col, extension):
+        return 'making:%s:%s:%s,%s.%s' % (
+            image.replace('/', ''), zoom, row, col, extension
+        )
+
+    def _get_tile_channel(self, image, size, zoom, row, col, extension):
+        """return the channel of the make_tile job for this tile, enqueuing
+        it unless another request (in any web process) already has"""
+        key = self._making_key(image, zoom, row, col, extension)
+        channel = new_channel()
+        if self.redis.setnx(key, channel):
+            # in case we never get to finish waiting for it
+            self.redis.expire(key, 60)
+            profile = self._get_profile(image, extension)
+            self.application.tile_batcher.add(
+                (image, size, zoom, extension,
+                 self.application.settings['static_path'], profile),
+                (int(row), int(col), channel)
             )
-            self.write(open(broken_filepath, 'rb').read())
+            self._prefetch(image, size, int(zoom), int(row), int(col),
+                           extension, profile)
+            return channel
+        return self.redis.get(key) or channel
 
-        self.finish()
+
+@route(r'/blanks/(?P<size>\d+)/(?P<name>[a-z]+-[0-9a-f]+)'
+       r'.(?P<extension>jpg|png)',
+       name='blank_tile')
+class BlankTileHandler(BaseHandler):
+    """Serves the shared tiles that are used instead of every tile that is
+    all one colour."""
+
+    def get(self, size, name, extension):
+        size = int(size)
+        if size != 256:
+            raise tornado.web.HTTPError(400, 'size must be 256')
+        if extension == 'png':
+            self.set_header('Content-Type', 'image/png')
+        else:
+            self.set_header('Content-Type', 'image/jpeg')
+        # only the tiles that were saved make blanks, anything else
+        # could be made up
+        blank_filepath = find_blank(
+            self.application.settings['static_path'],
+            size,
+            '%s.%s' % (name, extension)
+        )
+        if not blank_filepath:
+            raise tornado.web.HTTPError(404, "Blank not found")
+        self.set_header(
+            'Cache-Control',
+            'max-age=%d, public' % (60 * 60 * 24 * 360)
+        )
+        self.write(open(blank_filepath, 'rb').read())
+
+
+@route(r'/objects/(?P<prefix>[0-9a-f]{2})/(?P<name>[0-9a-f]+)'
+       r'.(?P<extension>jpg|png)',
+       name='object_tile')
+class ObjectTileHandler(BaseHandler):
+    """Serves the tiles that are stored once by their hash."""
+
+    def get(self, prefix, name, extension):
+        if extension == 'png':
+            self.set_header('Content-Type', 'image/png')
+        else:
+            self.set_header('Content-Type', 'image/jpeg')
+        object_filepath = get_object_path(
+            self.application.settings['static_path'],
+            '%s%s.%s' % (prefix, name, extension)
+        )
+        if not os.path.isfile(object_filepath):
+            raise tornado.web.HTTPError(404, "Object not found")
+        self.set_header(
+            'Cache-Control',
+            'max-age=%d, public' % (60 * 60 * 24 * 360)
+        )
+        self.write(open(object_filepath, 'rb').read())
 
 
 @route(r'/thumbnails/(?P<image>\w{1}/\w{2}/\w{6})/(?P<width>\w{1,3})'
@@ -1622,31 +2016,6 @@ class ThumbnailHandler(BaseHandler):
         width = int(width)
         assert width > 0 and width < 1000, width
 
-        # stick it on a queue
-        q = Queue(connection=self.redis)
-
-        job = q.enqueue(
-            make_thumbnail,
-            image,
-            width,
-            extension,
-            self.application.settings['static_path']
-        )
-        ioloop_instance = tornado.ioloop.IOLoop.instance()
-        delay = 0.1
-        thumbnail_filepath = None
-        while True:
-            yield tornado.gen.Task(
-                ioloop_instance.add_timeout,
-                time.time() + delay
-            )
-            delay *= 2
-            if job.result is not None:
-                thumbnail_filepath = job.result
-                break
-            elif delay > 2:
-                break
-
         if extension == 'png':
             self.set_header('Content-Type', 'image/png')
         elif extension == 'jpg':
@@ -1654,6 +2023,36 @@ class ThumbnailHandler(BaseHandler):
         else:
             raise ValueError(extension)
 
+        expected_filepath = thumbnail_filepath = os.path.join(
+            self.application.settings['static_path'],
+            'thumbnails',
+            image,
+            '%s.%s' % (width, extension)
+        )
+        if not os.path.isfile(thumbnail_filepath):
+            thumbnail_filepath = None
+
+            # stick it on a queue
+            q = Queue(connection=self.redis)
+
+            job = enqueue(
+                q,
+                make_thumbnail,
+                image,
+                width,
+                extension,
+                self.application.settings['static_path']
+            )
+            status = yield tornado.gen.Task(
+                self.application.job_waiter.wait,
+                job.channel,
+                3
+            )
+            # the job says it's done before rq has stored what it
+            # returned, so see for ourselves
+            if status == 'done' and os.path.isfile(expected_filepath):
+                thumbnail_filepath = expected_filepath
+
         if not thumbnail_filepath:
             self.set_header('Content-Type', 'image/png')
             thumbnail_filepath = os.path.join(
@@ -1666,20 +2065,12 @@ class ThumbnailHandler(BaseHandler):
                 'max-age=0'
             )
         else:
-            _cache_seconds = 60 * 60 * 24
-            self.set_header(
-                'Cache-Control',
-                'max-age=%d, public' % _cache_seconds
-            )
-            if _cache_seconds > 3600:
-                _expires = (
-                    datetime.datetime.utcnow() +
-                    datetime.timedelta(seconds=_cache_seconds)
-                )
-                self.set_header(
-                    'Expires',
-                    _expires.strftime('%a, %d %b %Y %H:%M:%S GMT')
-                )
+            self.set_cache_headers(60 * 60 * 24)
+            stat_ = os.stat(thumbnail_filepath)
+            etag = '%x-%x' % (int(stat_.st_mtime), stat_.st_size)
+            if self.check_not_modified(etag, stat_.st_mtime):
+                self.finish()
+                return
         self.write(open(thumbnail_filepath, 'rb').read())
         self.finish()
 
@@ -1688,8 +2079,6 @@ class ThumbnailHandler(BaseHandler):
 class PreloadURLsHandler(BaseHandler):
 
     def get(self, fileid):
-        root = self.application.settings['static_path']
-        path = os.path.join(root, 'tiles')
         image_filename = (
             fileid[:1] +
             '/' +
@@ -1697,16 +2086,18 @@ class PreloadURLsHandler(BaseHandler):
             '/' +
             fileid[3:]
         )
-        path = os.path.join(path, image_filename)
-        path = os.path.join(path, '256', str(self.DEFAULT_ZOOM))
+        extension = manifest.get_extension(self.redis, fileid)
 
         urls = []
-        if os.path.isdir(path):
-            for f in os.listdir(path):
-                urls.append(os.path.join(path, f).replace(
-                    self.application.settings['static_path'],
-                    ''
-                ))
+        for row, col in manifest.list_tiles(self.redis, fileid,
+                                            self.DEFAULT_ZOOM):
+            urls.append('/tiles/%s/256/%s/%s,%s.%s' % (
+                image_filename,
+                self.DEFAULT_ZOOM,
+                row,
+                col,
+                extension
+            ))
 
         self.write({'urls': urls})
 
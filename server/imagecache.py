@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from PIL import Image
+
+
+def image_bytes(im):
+    width, height = im.size
+    return width * height * len(im.getbands())
+
+
+class ImageCache(object):
+    """least-recently-used cache of decoded PIL images that never holds
+    more than `max_bytes` of pixels, unless it's the one image.
+
+    Images are keyed by the path they were opened from.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images = OrderedDict()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, key):
+        try:
+            im = self._images.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # put it back last, i.e. most recently used
+        self._images[key] = im
+        self.hits += 1
+        return im
+
+    def put(self, key, im):
+        size = image_bytes(im)
+        if key in self._images:
+            self.bytes -= image_bytes(self._images.pop(key))
+        self._images[key] = im
+        self.bytes += size
+        # one that's bigger than max_bytes on its own is still kept,
+        # until the next one, otherwise whoever opens it for every tile
+        # would decode it again every time
+        while self.bytes > self.max_bytes and len(self._images) > 1:
+            old_key, old = self._images.popitem(last=False)
+            self.bytes -= image_bytes(old)
+            self.evictions += 1
+            print "Evicted", old_key, "from image cache"
+
+    def open(self, path):
+        im = self.get(path)
+        if im is None:
+            im = Image.open(path)
+            im.load()
+            self.put(path, im)
+        return im
+
+    def clear(self):
+        self._images.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'images': len(self._images),
+            'bytes': self.bytes,
+        }
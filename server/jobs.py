@@ -0,0 +1,164 @@
+import time
+import uuid
+import logging
+from manifest import get_redis
+
+# Jobs enqueued with enqueue() publish 'done' or 'failed' on their own
+# channel when they finish and leave a key of the same name behind for a
+# while, so that the web processes can wait for them without polling
+# job.result. That's published before rq has stored what the job
+# returned, so job.result can still be None after 'done'.
+CHANNEL_PREFIX = 'job:'
+_DONE_SECONDS = 60 * 10
+
+
+def notifying(channel, func, *args, **kwargs):
+    """run `func` and then tell whoever is waiting on `channel`"""
+    try:
+        result = func(*args, **kwargs)
+    except:
+        notify(channel, 'failed')
+        raise
+    notify(channel, 'done')
+    return result
+
+
+def notify(channel, status):
+    redis_ = get_redis()
+    redis_.setex(channel, status, _DONE_SECONDS)
+    redis_.publish(channel, status)
+
+
+def new_channel():
+    return CHANNEL_PREFIX + uuid.uuid4().hex
+
+
+def enqueue(queue, func, *args, **kwargs):
+    """like queue.enqueue() but the job gets a `channel` that
+    JobWaiter.wait() can wait on"""
+    return enqueue_on(queue, new_channel(), func, *args, **kwargs)
+
+
+def enqueue_on(queue, channel, func, *args, **kwargs):
+    job = queue.enqueue(notifying, channel, func, *args, **kwargs)
+    job.channel = channel
+    return job
+
+
+class Batcher(object):
+    """collects the items added under the same key for `window` seconds
+    and then calls `dispatch(key, items)` once with all of them"""
+
+    def __init__(self, io_loop, window, dispatch):
+        self.io_loop = io_loop
+        self.window = window
+        self.dispatch = dispatch
+        self._batches = {}
+
+    def add(self, key, item):
+        if key not in self._batches:
+            self._batches[key] = []
+            self.io_loop.add_timeout(
+                time.time() + self.window,
+                lambda: self._flush(key)
+            )
+        self._batches[key].append(item)
+
+    def _flush(self, key):
+        self.dispatch(key, self._batches.pop(key))
+
+
+class JobWaiter(object):
+    """one subscription per web process to every job channel, read when
+    the IOLoop says its socket is readable"""
+
+    # how long to wait before subscribing again when redis goes away
+    RECONNECT_SECONDS = 1
+
+    def __init__(self, redis_, io_loop):
+        self.redis = redis_
+        self.io_loop = io_loop
+        self._waiting = {}
+        self._subscribe()
+
+    def _subscribe(self):
+        try:
+            self._pubsub = self.redis.pubsub()
+            self._pubsub.psubscribe(CHANNEL_PREFIX + '*')
+            self._fd = self._pubsub.connection._sock.fileno()
+        except Exception:
+            logging.error("Unable to subscribe to jobs", exc_info=True)
+            self.io_loop.add_timeout(
+                time.time() + self.RECONNECT_SECONDS,
+                self._subscribe
+            )
+            return
+        self.io_loop.add_handler(self._fd, self._on_readable,
+                                 self.io_loop.READ)
+        # tell whoever is waiting on jobs that finished while we weren't
+        # listening rather than leave them to time out
+        try:
+            for channel in list(self._waiting):
+                status = self.redis.get(channel)
+                if status:
+                    self._notify(channel, status)
+        except Exception:
+            logging.error("Unable to check the waited for jobs",
+                          exc_info=True)
+
+    def _on_readable(self, fd, events):
+        try:
+            # there might be more than one message already buffered
+            while True:
+                message = self._pubsub.get_message()
+                if message is None:
+                    break
+                if message['type'] == 'pmessage':
+                    self._notify(message['channel'], message['data'])
+        except Exception:
+            # e.g. redis was restarted
+            logging.error("Lost the job subscription", exc_info=True)
+            self.io_loop.remove_handler(self._fd)
+            try:
+                self._pubsub.close()
+            except Exception:
+                pass
+            self.io_loop.add_timeout(
+                time.time() + self.RECONNECT_SECONDS,
+                self._subscribe
+            )
+
+    def _notify(self, channel, status):
+        for callback in self._waiting.pop(channel, []):
+            callback(status)
+
+    def wait(self, channel, timeout, callback):
+        """call `callback` with 'done' or 'failed' once the job on
+        `channel` has finished or with None if it hasn't within `timeout`
+        seconds"""
+        state = {}
+
+        def finish(status):
+            if state.get('finished'):
+                return
+            state['finished'] = True
+            self.io_loop.remove_timeout(state['timeout'])
+            callbacks = self._waiting.get(channel, [])
+            if finish in callbacks:
+                callbacks.remove(finish)
+                if not callbacks:
+                    del self._waiting[channel]
+            callback(status)
+
+        def timed_out():
+            finish(self.redis.get(channel))
+
+        self._waiting.setdefault(channel, []).append(finish)
+        state['timeout'] = self.io_loop.add_timeout(
+            time.time() + timeout,
+            timed_out
+        )
+        # it might have been done before we started listening
+        status = self.redis.get(channel)
+        if status:
+            finish(status)
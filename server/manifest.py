@@ -0,0 +1,124 @@
+import os
+import redis.client
+import settings
+
+# For every image and zoom level there's a bitmap in redis with one bit
+# per tile, set once the tile has been made, and a hash with the
+# extension and how many tiles and bytes each zoom level has so far.
+# Bit `col * 2 ** zoom + row` is the tile row,col since every zoom level
+# is 2 ** zoom tiles wide.
+#
+#   manifest:<fileid>:<zoom>   bitmap
+#   manifest:<fileid>          count:<zoom>, bytes:<zoom>, extension,
+#                              rebuilt
+
+_redis = None
+
+
+def get_redis():
+    """the connection the queue workers use"""
+    global _redis
+    if _redis is None:
+        _redis = redis.client.Redis(
+            settings.REDIS_HOST,
+            settings.REDIS_PORT
+        )
+    return _redis
+
+
+def _slot(zoom, row, col):
+    return col * 2 ** int(zoom) + row
+
+
+def parse_tile_path(save_filepath, static_path):
+    """return (fileid, zoom, row, col, extension) for a path like
+    <static_path>/tiles/a/bc/def/256/<zoom>/<row>,<col>.<extension>"""
+    bits = os.path.relpath(save_filepath, static_path).split(os.sep)
+    assert bits[0] == 'tiles' and len(bits) == 7, save_filepath
+    coordinates, extension = os.path.splitext(bits[-1])
+    row, col = [int(x) for x in coordinates.split(',')]
+    return ''.join(bits[1:4]), int(bits[5]), row, col, extension[1:]
+
+
+def record_tile(redis_, fileid, zoom, row, col, extension, bytes):
+    """mark the tile as made, returns True if it wasn't before"""
+    key = 'manifest:%s' % fileid
+    if redis_.setbit('%s:%s' % (key, zoom), _slot(zoom, row, col), 1):
+        return False
+    pipe = redis_.pipeline()
+    pipe.hincrby(key, 'count:%s' % zoom, 1)
+    pipe.hincrby(key, 'bytes:%s' % zoom, bytes)
+    pipe.hset(key, 'extension', extension)
+    pipe.execute()
+    return True
+
+
+def mark_rebuilt(redis_, fileid):
+    """make sure the image has a manifest even if it has no tiles"""
+    redis_.hset('manifest:%s' % fileid, 'rebuilt', 1)
+
+
+def has_manifest(redis_, fileid):
+    return redis_.exists('manifest:%s' % fileid)
+
+
+def count_tiles(redis_, fileid):
+    return sum(
+        int(value)
+        for (field, value) in redis_.hgetall('manifest:%s' % fileid).items()
+        if field.startswith('count:')
+    )
+
+
+def get_bytes(redis_, fileid):
+    """return a dict of zoom -> how many bytes its tiles are"""
+    return dict(
+        (int(field.split(':')[1]), int(value))
+        for (field, value) in redis_.hgetall('manifest:%s' % fileid).items()
+        if field.startswith('bytes:')
+    )
+
+
+def get_extension(redis_, fileid):
+    return redis_.hget('manifest:%s' % fileid, 'extension')
+
+
+def get_tiles(redis_, fileid, zoom, rows, cols):
+    """return a dict of "row,col" -> True/False for the whole grid"""
+    bitmap = redis_.get('manifest:%s:%s' % (fileid, zoom)) or ''
+    tiles = {}
+    for row in range(rows):
+        for col in range(cols):
+            slot = _slot(zoom, row, col)
+            byte = slot / 8
+            tiles['%s,%s' % (row, col)] = bool(
+                byte < len(bitmap) and
+                ord(bitmap[byte]) & (0x80 >> (slot % 8))
+            )
+    return tiles
+
+
+def list_tiles(redis_, fileid, zoom):
+    """return a list of (row, col) of every tile made at `zoom`"""
+    bitmap = redis_.get('manifest:%s:%s' % (fileid, zoom)) or ''
+    width = 2 ** int(zoom)
+    tiles = []
+    for byte, char in enumerate(bitmap):
+        value = ord(char)
+        if not value:
+            continue
+        for bit in range(8):
+            if value & (0x80 >> bit):
+                slot = byte * 8 + bit
+                tiles.append((slot % width, slot / width))
+    return tiles
+
+
+def clear(redis_, fileid):
+    key = 'manifest:%s' % fileid
+    zooms = [
+        field.split(':')[1]
+        for field in redis_.hkeys(key)
+        if field.startswith('count:')
+    ]
+    redis_.delete(key, *['%s:%s' % (key, zoom) for zoom in zooms])
@@ -1,11 +1,28 @@
 import time
 import os
+import errno
+import hashlib
 from glob import glob
 import subprocess
 import stat
+import logging
+import multiprocessing
+from atomicfile import temporary_path, create_once
+from cStringIO import StringIO
+from PIL import Image
+from tilestore import (
+    read_index, get_object_path, save_image, PACK_FILENAME
+)
+import settings
 
 
-def optimize_images(image, zoom, extension, static_path):
+def get_cache_root(static_path):
+    if settings.OPTIMIZE_CACHE:
+        return os.path.join(static_path, 'optimized')
+
+
+def optimize_images(image, zoom, extension, static_path, profile=None):
+    profile = profile or settings.TILE_ENCODE_PROFILE
     root = os.path.join(
         static_path,
         'tiles'
@@ -14,12 +31,32 @@ def optimize_images(image, zoom, extension, static_path):
     total_before = 0
     search_path = os.path.join(root, '*.%s' % extension)
     files = glob(search_path)
+    # and the objects of the tiles that are stored by their hash
+    files.extend(set(
+        get_object_path(static_path, name)
+        for name in read_index(root).values()
+    ))
+    if os.path.isfile(os.path.join(root, PACK_FILENAME)):
+        # the bytes of packed tiles can't change size once they're
+        # appended, they're only as optimized as TILE_ENCODE_PROFILE
+        # made them
+        print "Not optimizing the packed tiles of", image, "zoom", zoom
     for each in files:
         size = os.stat(each)[stat.ST_SIZE]
         #print each, "IS", size
         total_before += size
     t0 = time.time()
-    out, err = _optimize(files, extension)
+    quantize = extension == 'png' and profile == 'quantized'
+    if profile != 'plain':
+        # they were optimized when they were saved, only carry on if
+        # it's worth it
+        results = _optimize(files, extension,
+                            cache_root=get_cache_root(static_path),
+                            min_saving=settings.OPTIMIZE_MIN_SAVING,
+                            quantize=quantize)
+    else:
+        results = _optimize(files, extension,
+                            cache_root=get_cache_root(static_path))
     t1 = time.time()
 
     total_after = 0
@@ -29,9 +66,16 @@ def optimize_images(image, zoom, extension, static_path):
     def kb(s):
         return "%.1fKb" % (s / 1000.0)
 
-    print "Took", round(t1 - t0, 2), "seconds to optimize", len(files), "tiles"
+    print "Took", round(t1 - t0, 2), "seconds to optimize", len(results),
+    print "tiles,", len(files) - len(results), "were skipped"
     print "From", kb(total_before), "to", kb(total_after),
     print "saving", kb(total_before - total_after)
+    if results:
+        before = sum(x[0] for x in results.values())
+        after = sum(x[1] for x in results.values())
+        print "Per tile", kb(before / len(results)), "to",
+        print kb(after / len(results)),
+        print "(%.1f times smaller)" % (float(before) / max(after, 1))
 
 def optimize_thumbnails(image, extension, static_path):
     root = os.path.join(
@@ -47,7 +91,8 @@ def optimize_thumbnails(image, extension, static_path):
         print each, "IS", size
         total_before += size
     t0 = time.time()
-    out, err = _optimize(files, extension)
+    results = _optimize(files, extension,
+                        cache_root=get_cache_root(static_path))
     t1 = time.time()
 
     total_after = 0
@@ -57,29 +102,242 @@ def optimize_thumbnails(image, extension, static_path):
     def kb(s):
         return "%.1fKb" % (s / 1000.0)
 
-    print "Took", round(t1 - t0, 2), "seconds to optimize", len(files), "thumbnails"
+    print "Took", round(t1 - t0, 2), "seconds to optimize", len(results),
+    print "thumbnails,", len(files) - len(results), "were skipped"
     print "From", kb(total_before), "to", kb(total_after),
     print "Saving", kb(total_before - total_after)
 
 
-def _optimize(files, extension):
-    if extension == 'jpg':
-        cmd = "jpegoptim --strip-all %s" % (' '.join(files))
-    elif extension == 'png':
-        cmd = "optipng %s" % (' '.join(files))
-    else:
+_COMMANDS = {
+    'jpg': ['jpegoptim', '--strip-all'],
+    'png': ['optipng'],
+}
+
+# every directory with optimized files gets one of these, one line per
+# file as "filename bytes-before bytes-after seconds"
+OPTIMIZED_FILENAME = '.optimized'
+
+
+def _read_optimized(directory):
+    optimized = {}
+    try:
+        lines = open(os.path.join(directory, OPTIMIZED_FILENAME))
+    except IOError:
+        return optimized
+    for line in lines:
+        if line.strip():
+            name, before, after, seconds = line.split()
+            optimized[name] = (int(before), int(after), float(seconds))
+    return optimized
+
+
+def _record_optimized(results):
+    for path, (before, after, seconds) in results.items():
+        directory, name = os.path.split(path)
+        open(os.path.join(directory, OPTIMIZED_FILENAME), 'a').write(
+            '%s %d %d %.3f\n' % (name, before, after, seconds)
+        )
+
+
+def _optimize(files, extension, cache_root=None, processes=None,
+              batch_size=None, min_saving=None, quantize=False):
+    """optimize `files` on a pool of processes, `batch_size` files at a
+    time, skipping those that were optimized before and haven't changed
+    since.
+
+    With `cache_root` the optimized bytes of every file are kept there
+    by the hash of the bytes before, so a file that's the same as one
+    optimized before, of any image, is copied instead of optimized again.
+
+    With `quantize` PNGs are reduced to a palette first, see
+    tilestore.quantize_tile().
+
+    With `min_saving` the first batch is done on its own and if it saved
+    less than that fraction of its bytes the rest aren't bothered with.
+
+    Returns a dict of path -> (bytes before, bytes after, seconds) of the
+    files that were optimized now.
+    """
+    if extension not in _COMMANDS:
         raise NotImplementedError(extension)
-    process = subprocess.Popen(
-        cmd,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
+    processes = (
+        processes or
+        settings.OPTIMIZE_PROCESSES or
+        multiprocessing.cpu_count()
     )
-    out, err = process.communicate()
-    #print out
-    #print 'ERRROR'
-    #print err
-    return (out, err)
+    batch_size = batch_size or settings.OPTIMIZE_BATCH_SIZE
+
+    optimized = {}
+    todo = []
+    for each in files:
+        directory, name = os.path.split(each)
+        if directory not in optimized:
+            optimized[directory] = _read_optimized(directory)
+        done = optimized[directory].get(name)
+        if done and done[1] == os.stat(each)[stat.ST_SIZE]:
+            continue
+        todo.append(each)
+
+    batches = [
+        (todo[i:i + batch_size], extension, cache_root, quantize)
+        for i in range(0, len(todo), batch_size)
+    ]
+    results = {}
+    if batches and min_saving:
+        sample = _optimize_batch(batches.pop(0))
+        _record_optimized(sample)
+        results.update(sample)
+        before = sum(x[0] for x in sample.values())
+        after = sum(x[1] for x in sample.values())
+        if before and float(before - after) / before < min_saving:
+            print "Only saved", before - after, "of", before, "bytes on",
+            print len(sample), "files, not optimizing the rest"
+            return results
+    if not batches:
+        return results
+    pool = multiprocessing.Pool(min(processes, len(batches)))
+    try:
+        for batch_results in pool.imap_unordered(_optimize_batch, batches):
+            _record_optimized(batch_results)
+            results.update(batch_results)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def _optimize_batch(args):
+    files, extension, cache_root, quantize = args
+    results = {}
+    for each in files:
+        data = open(each, 'rb').read()
+        before = len(data)
+        cached = None
+        if cache_root:
+            cached = _get_cache_path(
+                cache_root,
+                data,
+                # it's not the same result
+                quantize and 'quantized.' + extension or extension
+            )
+        # optimize a copy and then rename it back so that nobody serving
+        # or uploading a tile in the meantime gets a half written file
+        copy = temporary_path(each)
+        try:
+            t0 = time.time()
+            if cached and os.path.isfile(cached):
+                optimized = open(cached, 'rb').read()
+                _touch_cached(cached)
+                if not optimized or optimized == data:
+                    # it's already the optimized version
+                    results[each] = (before, before, time.time() - t0)
+                    continue
+                try:
+                    # the same bytes only take room once
+                    os.link(cached, copy)
+                except OSError:
+                    open(copy, 'wb').write(optimized)
+            else:
+                open(copy, 'wb').write(data)
+                if quantize:
+                    _quantize(copy)
+                process = subprocess.Popen(
+                    _COMMANDS[extension] + [copy],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE
+                )
+                out, err = process.communicate()
+                if process.returncode:
+                    # leave it out so it's tried again next time
+                    logging.error("Unable to optimize %s: %s" % (each, err))
+                    continue
+                if cached:
+                    _add_to_cache(cache_root, cached, copy,
+                                  quantize and 'quantized.' + extension or
+                                  extension)
+            t1 = time.time()
+            os.rename(copy, each)
+            results[each] = (before, os.stat(each)[stat.ST_SIZE], t1 - t0)
+        finally:
+            if os.path.isfile(copy):
+                os.remove(copy)
+    return results
+
+
+def _quantize(path):
+    im = Image.open(path)
+    im.load()
+    buffer_ = StringIO()
+    # which also keeps whatever is smallest
+    save_image(im, buffer_, '.png', 'quantized')
+    data = buffer_.getvalue()
+    if len(data) < os.stat(path)[stat.ST_SIZE]:
+        open(path, 'wb').write(data)
+
+
+def _get_cache_path(cache_root, data, extension):
+    name = hashlib.sha1(data).hexdigest()
+    return os.path.join(cache_root, name[:2], '%s.%s' % (name[2:], extension))
+
+
+def _add_to_cache(cache_root, cached, optimized_path, extension):
+    """remember what the bytes that hash to `cached` optimize to, and that
+    those optimize to themselves.
+
+    The first is a hard link to the optimized file, which becomes the
+    tile, so it takes no more room for as long as the tile is there. The
+    second is an empty file, all it has to say is that there's nothing
+    to do.
+    """
+    optimized = open(optimized_path, 'rb').read()
+    marker = _get_cache_path(cache_root, optimized, extension)
+    for path in (cached, marker):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+    try:
+        os.link(optimized_path, cached)
+    except OSError as exception:
+        if exception.errno != errno.EEXIST:
+            # e.g. static/optimized is on another file system
+            create_once(cached, lambda tmp: open(tmp, 'wb').write(optimized))
+    create_once(marker, lambda tmp: open(tmp, 'wb').close())
+
+
+def _touch_cached(cached):
+    """mark a cache entry as used, see prune_cache()"""
+    try:
+        if os.stat(cached).st_nlink == 1:
+            # not while it's linked, that would touch the tile too
+            os.utime(cached, None)
+    except OSError:
+        pass
+
+
+def prune_cache(cache_root, max_age):
+    """remove what's in the cache that hasn't been used for `max_age`
+    seconds, except the entries that are still the bytes of a tile or
+    thumbnail somewhere. Returns how many bytes that freed."""
+    if not os.path.isdir(cache_root):
+        return 0
+    too_old = time.time() - max_age
+    freed = 0
+    for directory, directories, filenames in os.walk(cache_root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                stat_ = os.stat(path)
+                if stat_.st_nlink > 1 or stat_.st_mtime > too_old:
+                    continue
+                os.remove(path)
+            except OSError as exception:
+                if exception.errno != errno.ENOENT:
+                    raise
+                continue
+            freed += stat_.st_size
+    return freed
 
 
 if __name__ == '__main__':
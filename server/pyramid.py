@@ -0,0 +1,110 @@
+import os
+import time
+from PIL import Image
+from resizer import make_resize
+from tilestore import save_tile, tile_exists, prepare_tile_directory
+
+
+def make_pyramid(image, size, ranges, grids, extension, static_path,
+                 resize_engine=None, profile=None):
+    """make all the tiles for all the zoom levels in `ranges` by only
+    decoding one image.
+
+    The biggest zoom level is cut from its resized intermediate (made with
+    `resize_engine` if it doesn't already exist) and every zoom level below
+    that is made by downsampling 2x2 tiles of the zoom level above it.
+    They're saved in the order of `ranges`.
+    `grids` is a dict of zoom -> (rows, cols) as returned by
+    utils.get_tile_grid(). The tiles are saved with the encode `profile`,
+    TILE_ENCODE_PROFILE if it's None.
+    """
+    size = int(size)
+    assert size == 256, size
+
+    root = os.path.join(
+        static_path,
+        'uploads'
+    )
+    for i in ('.png', '.jpg'):
+        path = os.path.join(root, image + i)
+        if os.path.isfile(path):
+            break
+    else:
+        raise IOError(image)
+
+    # saved in the order they're asked for, the first one is what users
+    # see first
+    order = [int(x) for x in ranges]
+    ranges = sorted(order)
+    top = ranges[-1]
+
+    t0 = time.time()
+    im = Image.open(make_resize(path, top, engine=resize_engine))
+    if im.mode not in ('RGB', 'RGBA', 'L', 'CMYK'):
+        # palette images can't be downsampled nicely
+        im = im.convert(extension == 'png' and 'RGBA' or 'RGB')
+    im.load()
+    t1 = time.time()
+    print "Took", round(t1 - t0, 2), "seconds to open zoom", top
+
+    rows, cols = grids[top]
+    tiles = {}
+    for row in range(rows):
+        for col in range(cols):
+            box = (size * row, size * col, size * (row + 1), size * (col + 1))
+            tiles[(row, col)] = im.crop(box)
+    mode = im.mode
+    del im  # the tiles are all we need from now on
+
+    # every zoom level is downsampled first, which is only a third more
+    # than the top one, so they can be saved in any order
+    blank = Image.new(mode, (size, size))
+    levels = {}
+    zoom = top
+    while True:
+        if zoom in ranges:
+            levels[zoom] = (tiles, (rows, cols))
+        if zoom == ranges[0]:
+            break
+        zoom -= 1
+        if zoom in grids:
+            rows, cols = grids[zoom]
+        else:
+            rows, cols = (rows + 1) / 2, (cols + 1) / 2
+        tiles = dict(
+            ((row, col), _downsample(tiles, row, col, size, mode, blank))
+            for row in range(rows)
+            for col in range(cols)
+        )
+
+    for zoom in order:
+        tiles, grid = levels.pop(zoom)
+        t0 = time.time()
+        _save_tiles(tiles, image, size, zoom, grid, extension, static_path,
+                    profile)
+        t1 = time.time()
+        print "Took", round(t1 - t0, 2), "seconds to save",
+        print len(tiles), "tiles for zoom", zoom
+
+
+def _downsample(tiles, row, col, size, mode, blank):
+    canvas = Image.new(mode, (size * 2, size * 2))
+    for x in (0, 1):
+        for y in (0, 1):
+            child = tiles.get((row * 2 + x, col * 2 + y), blank)
+            canvas.paste(child, (size * x, size * y))
+    return canvas.resize((size, size), Image.ANTIALIAS)
+
+
+def _save_tiles(tiles, image, size, zoom, grid, extension, static_path,
+                profile):
+    save_dir = os.path.join(static_path, 'tiles', image, str(size), str(zoom))
+    prepare_tile_directory(save_dir, *grid)
+    for (row, col), tile in tiles.items():
+        save_filepath = os.path.join(
+            save_dir,
+            '%s,%s.%s' % (row, col, extension)
+        )
+        if not tile_exists(save_filepath):
+            save_tile(tile, save_filepath, static_path, size,
+                      profile=profile)
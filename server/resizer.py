@@ -3,14 +3,31 @@ import time
 import os
 import logging
 import subprocess
+from PIL import Image
+import settings
+from atomicfile import create_once
 
 
-def resize_image(path, width, save_path):
+def resize_image(path, width, save_path, memory_limit=None, engine=None):
+    engine = engine or settings.RESIZE_ENGINE
+    if engine == 'pil' and not memory_limit:
+        # PIL can't resize without decoding everything so only `convert`
+        # can keep to a memory limit
+        return _pil_resize_image(path, width, save_path)
+    assert engine in ('convert', 'pil'), engine
     _resize_tool = 'resize'
     cmd = (
         'convert %s -%s %d %s' %
         (path, _resize_tool, width, save_path)
     )
+    if memory_limit:
+        # anything that doesn't fit goes to ImageMagick's disk cache
+        cmd = cmd.replace(
+            'convert ',
+            'convert -limit memory %d -limit map %d ' %
+            (memory_limit, memory_limit),
+            1
+        )
     cmd = 'MAGICK_THREAD_LIMIT=1 ' + cmd
     print "CMD", repr(cmd)
     process = subprocess.Popen(
@@ -25,24 +42,63 @@ def resize_image(path, width, save_path):
     return save_path
 
 
-def make_resizes(path, ranges):
+def _pil_resize_image(path, width, save_path):
+    im = Image.open(path)
+    x, y = im.size
+    height = max(1, int(round(float(y) * width / x)))
+    if im.format == 'JPEG':
+        # libjpeg can decode at 1/2, 1/4 or 1/8 of the size for almost
+        # free and draft() picks the smallest of those that is still
+        # at least as big as what we need
+        im.draft(im.mode, (width, height))
+    if im.mode not in ('RGB', 'RGBA', 'L', 'CMYK'):
+        if 'transparency' in im.info:
+            im = im.convert('RGBA')
+        else:
+            im = im.convert('RGB')
+    factor = min(im.size[0] / width, im.size[1] / height)
+    if factor > 1 and hasattr(im, 'reduce'):
+        # cheap box filter down to near the right size first
+        im = im.reduce(factor)
+    im = im.resize((width, height), Image.ANTIALIAS)
+    if save_path.endswith('.jpg'):
+        im.save(save_path, quality=90)
+    else:
+        im.save(save_path)
+    return save_path
+
+
+def make_resizes(path, ranges, engine=None, cascade=False,
+                 memory_limit=None):
+    source = path
+    if cascade:
+        # biggest first so that every zoom level can be made from the
+        # one above it which is 4 times smaller than the one before that
+        ranges = sorted(ranges, reverse=True)
+    resized_files = []
     for zoom in ranges:
         #print path, zoom
         t0 = time.time()
-        resized = _resize(path, zoom)
+        resized = _resize(path, zoom, memory_limit=memory_limit,
+                          engine=engine, source=source)
         t1 = time.time()
         print "Created", resized, "in", round(t1 - t0, 3), "seconds"
+        resized_files.append(resized)
+        if cascade:
+            source = resized
+    return resized_files
 
 
-def make_resize(path, zoom):
+def make_resize(path, zoom, memory_limit=None, engine=None):
     t0 = time.time()
-    resized = _resize(path, zoom)
+    resized = _resize(path, zoom, memory_limit=memory_limit, engine=engine)
     t1 = time.time()
     print "Created", resized, "in", round(t1 - t0, 3), "seconds"
     return resized
 
 
-def _resize(path, zoom, extra=0):
+def _resize(path, zoom, extra=0, memory_limit=None, engine=None,
+            source=None):
     width = 256 * (2 ** zoom)
 
     start, ext = os.path.splitext(path)
@@ -50,6 +106,9 @@ def _resize(path, zoom, extra=0):
         ext,
         '-%s-%s%s' % (zoom, width, ext)
     )
-    if os.path.isfile(save_path):
-        return save_path
-    return resize_image(path, width, save_path)
+    # if another worker is already making it, this waits for that
+    return create_once(
+        save_path,
+        lambda tmp: resize_image(source or path, width, tmp,
+                                 memory_limit=memory_limit, engine=engine)
+    )
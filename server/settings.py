@@ -15,6 +15,85 @@ DEFAULT_CDN_TILER_DOMAIN = 'd220r9wol91huc.cloudfront.net'
 TILES_BUCKET_ID = 'tiler-tiles'
 ORIGINALS_BUCKET_ID = 'tiler-originals'
 
+# 'pyramid' cuts the biggest zoom level and downsamples that for every
+# zoom level below it, 'resize' resizes the original once per zoom level
+# and 'strip' is like 'resize' but cuts tiles from horizontal strips so no
+# more than TILING_MEMORY_BUDGET bytes of pixels are ever held in memory
+# and 'parallel' is like 'resize' but cuts the tiles of a zoom level on
+# TILING_PROCESSES processes (0 means one per CPU)
+TILING_ENGINE = 'pyramid'
+TILING_MEMORY_BUDGET = 256 * 1024 * 1024
+TILING_PROCESSES = 0
+
+# 'convert' resizes with ImageMagick in a subprocess, 'pil' resizes in
+# process and lets JPEGs be decoded straight to 1/2, 1/4 or 1/8 of the size.
+# With the 'strip' tiling engine the resizes are always made with 'convert'
+# so they keep to TILING_MEMORY_BUDGET.
+RESIZE_ENGINE = 'convert'
+# when not using the pyramid engine, make each zoom level from the resized
+# zoom level above it instead of from the original
+RESIZE_CASCADE = True
+
+# 'files' writes every tile to its own file under static/tiles/, 'cas'
+# writes each distinct tile once under static/objects/ named by its hash
+# and keeps an index of which tile has which hash, 'packed' appends all
+# the tiles of a zoom level to one file with a fixed width index next to it.
+# Packed tiles are never optimized afterwards so they're best saved with
+# a TILE_ENCODE_PROFILE other than 'plain'.
+TILE_STORAGE = 'files'
+
+# 'plain' saves tiles with PIL's defaults, 'optimized' saves PNGs
+# optimized and as palette images when that loses nothing and JPEGs
+# optimized and progressive, so that optimize_images() has little to do.
+# 'quantized' is 'optimized' but PNGs with more colours than a palette
+# has are reduced to one too, unless that's worse than the PSNR floor.
+TILE_ENCODE_PROFILE = 'plain'
+TILE_QUANTIZE_COLOURS = 256
+TILE_QUANTIZE_DITHER = False
+TILE_QUANTIZE_MIN_PSNR = 35.0
+
+# 'original' makes the tiles in the format of the original with
+# TILE_ENCODE_PROFILE, 'auto' looks at a preview of every upload once and
+# picks the format and profile of its tiles, so that photographs uploaded
+# as PNG get JPEG tiles. JPEG originals always get JPEG tiles. PNGs that
+# use their alpha channel, or have few colours or little entropy, in bits
+# per pixel of the luminance, keep PNG tiles. With
+# TILE_FORMAT_QUANTIZE_ALPHA those that use their alpha channel but are
+# photographs otherwise get the lossy 'quantized' profile.
+TILE_FORMAT = 'auto'
+TILE_FORMAT_PREVIEW_SIZE = 512
+TILE_FORMAT_MAX_PNG_COLOURS = 4096
+TILE_FORMAT_MIN_JPEG_ENTROPY = 5.0
+TILE_FORMAT_QUANTIZE_ALPHA = False
+
+# how many bytes of decoded pixels a queue worker may keep cached
+RESIZE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# how many processes optimize tiles at once, 0 means one per CPU, and how
+# many files each of them is given at a time
+OPTIMIZE_PROCESSES = 0
+OPTIMIZE_BATCH_SIZE = 50
+# with TILE_ENCODE_PROFILE = 'optimized' the tiles are only optimized
+# again if the first batch of them gets at least this much smaller
+OPTIMIZE_MIN_SAVING = 0.02
+# keep the optimized bytes of every tile and thumbnail under
+# static/optimized/ by the hash of what they were before so the same
+# bytes are never optimized twice. bin/prune-optimized.py removes what
+# hasn't been used for OPTIMIZE_CACHE_MAX_AGE seconds and isn't a tile or
+# thumbnail any more.
+OPTIMIZE_CACHE = True
+OPTIMIZE_CACHE_MAX_AGE = 60 * 60 * 24 * 30
+
+# how many seconds to collect on demand tile requests for the same image
+# and zoom level for before making them all in one job
+TILE_BATCH_WINDOW = 0.005
+
+# when a tile has to be made on demand also make the tiles this many rows
+# and cols around it, and with TILE_PREFETCH_CHILDREN the four under it at
+# the next zoom level, in one job. 0 and False to not prefetch.
+TILE_PREFETCH_RADIUS = 1
+TILE_PREFETCH_CHILDREN = True
+
 from local_settings import *
 
 assert BROWSERID_DOMAIN
@@ -180,7 +180,8 @@ var TrackKeeper = (function() {
   var pathname;
 
   function path(url) {
-    return url.match(/\d\/\d+,\d+/g)[0];
+    var match = url.match(/\d\/\d+,\d+/g);
+    return match && match[0];
   }
 
   function humanize_size(filesize) {
@@ -213,8 +214,11 @@ var TrackKeeper = (function() {
      },
      notice: function(url) {
        var p = path(url);
+       if (!p) {
+         return;
+       }
        if (!extension) {
-         extension = url.match(/\.[a-z]+$/g)[0];
+         extension = url.match(/\.[a-z]+(?=#|$)/g)[0];
        }
        if ($.inArray(p, urls) === -1) {
          urls.push(p);
@@ -389,9 +393,26 @@ $(function() {
   var hide_download_counter = $body.data('hide-download-counter');
   var hide_annotations = $body.data('hide-annotations');
   var default_location = $body.data('default-location');
+  var aliases = $body.data('aliases') || {};
+
+  // some tiles aren't stored under their own URL, like the ones that are
+  // all one colour which share the same blank tile or the ones that are
+  // stored once by their hash
+  var TileLayer = L.TileLayer.extend({
+    getTileUrl: function(tilePoint) {
+      var url = L.TileLayer.prototype.getTileUrl.call(this, tilePoint);
+      var zoom = this._getZoomForUrl();
+      var coordinates = tilePoint.x + ',' + tilePoint.y;
+      if (aliases[zoom] && aliases[zoom][coordinates]) {
+        // the fragment is so TrackKeeper still knows which tile it is
+        return prefix + aliases[zoom][coordinates] + '#' + zoom + '/' + coordinates;
+      }
+      return url;
+    }
+  });
 
   var tiles_url = prefix + '/tiles/' + image + '/256/{z}/{x},{y}.' + extension;
-  var map_layer = new L.TileLayer(tiles_url, {
+  var map_layer = new TileLayer(tiles_url, {
       minZoom: range_min,
       maxZoom: range_max,
       zoomControl: range_max > range_min
@@ -0,0 +1,107 @@
+import math
+import json
+import time
+from PIL import Image
+from manifest import get_redis
+from resizer import make_resize
+import settings
+
+# what record_tile_format() decided, for the web process to pick up once
+# the job is done, as JSON [extension, profile]
+_KEY = 'tileformat:%s'
+
+
+def analyse_image(path):
+    """return a dict of the image's format, whether it's grey, whether
+    it uses its alpha channel, how many colours it has (None if more than
+    TILE_FORMAT_MAX_PNG_COLOURS) and the entropy of its luminance in bits
+    per pixel.
+
+    `path` should be a resize of the original, not the original, since
+    it's decoded whole. The colours and entropy are of a preview of it no
+    bigger than TILE_FORMAT_PREVIEW_SIZE but the alpha is of all of it
+    since a few transparent pixels are enough to need PNG tiles.
+    """
+    size = settings.TILE_FORMAT_PREVIEW_SIZE
+    im = Image.open(path)
+    format = im.format
+    # only does anything for JPEGs
+    im.draft('RGB', (size, size))
+    grey = im.mode in ('L', 'LA')
+    if im.mode in ('P', 'LA') or 'transparency' in im.info:
+        im = im.convert('RGBA')
+    elif im.mode not in ('RGB', 'RGBA', 'L'):
+        im = im.convert('RGB')
+    alpha = False
+    if im.mode == 'RGBA':
+        alpha = im.split()[-1].getextrema()[0] < 255
+    # nearest so that it doesn't make up colours in between
+    im.thumbnail((size, size), Image.NEAREST)
+    colours = im.getcolors(settings.TILE_FORMAT_MAX_PNG_COLOURS)
+    histogram = im.convert('L').histogram()
+    pixels = float(sum(histogram))
+    entropy = -sum(
+        count / pixels * math.log(count / pixels, 2)
+        for count in histogram
+        if count
+    )
+    return {
+        'format': format,
+        'grey': grey,
+        'alpha': alpha,
+        'colours': colours and len(colours) or None,
+        'entropy': entropy,
+    }
+
+
+def choose_tile_format(path):
+    """return the (extension, encode profile) the tiles of the image at
+    `path` should have"""
+    analysis = analyse_image(path)
+    if analysis['format'] == 'JPEG':
+        # it's already been through JPEG, lossless tiles of it would only
+        # be bigger
+        return 'jpg', 'optimized'
+    photographic = _is_photographic(analysis)
+    if analysis['alpha']:
+        # only PNG can keep it
+        if photographic and settings.TILE_FORMAT_QUANTIZE_ALPHA:
+            return 'png', 'quantized'
+        return 'png', 'optimized'
+    if photographic:
+        return 'jpg', 'optimized'
+    return 'png', 'optimized'
+
+
+def _is_photographic(analysis):
+    if analysis['entropy'] < settings.TILE_FORMAT_MIN_JPEG_ENTROPY:
+        return False
+    # a grey image never has more than 256 colours, photograph or not
+    return analysis['grey'] or analysis['colours'] is None
+
+
+def record_tile_format(fileid, path, zoom, resize_engine=None,
+                       memory_limit=None):
+    """the queue job that picks the tile format of an upload by looking
+    at its resize for `zoom`, which the tiles need anyway"""
+    t0 = time.time()
+    resized = make_resize(path, zoom, memory_limit=memory_limit,
+                          engine=resize_engine)
+    extension, profile = choose_tile_format(resized)
+    t1 = time.time()
+    print "Took", round(t1 - t0, 2), "seconds to choose",
+    print extension, profile, "tiles for", fileid
+    get_redis().setex(
+        _KEY % fileid,
+        json.dumps([extension, profile]),
+        60 * 60
+    )
+    return extension, profile
+
+
+def get_tile_format(redis_, fileid):
+    """return what record_tile_format() chose for `fileid` or None if it
+    hasn't (yet)"""
+    value = redis_.get(_KEY % fileid)
+    if value:
+        return tuple(json.loads(value))
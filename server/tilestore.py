@@ -0,0 +1,575 @@
+import os
+import math
+import mmap
+import errno
+import struct
+import hashlib
+from collections import OrderedDict
+from cStringIO import StringIO
+from PIL import Image, ImageChops, ImageStat
+from atomicfile import create_once, write_atomically, path_lock
+from manifest import get_redis, parse_tile_path, record_tile
+import settings
+
+# every zoom directory of tiles can have one of these listing the tiles
+# that were all one colour and therefore never written, one per line as
+# "row,col blank-name"
+BLANKS_FILENAME = '.blanks'
+# and with TILE_STORAGE = 'cas' one of these listing which object in
+# static/objects/ has the bytes of each tile, one per line as
+# "row,col object-name"
+INDEX_FILENAME = '.index'
+
+# and with TILE_STORAGE = 'packed' all the tiles of a zoom level are
+# appended to one file and the offset and length of each tile is kept in
+# a fixed width slot, one for every row,col of the grid, in the other
+PACK_FILENAME = '.pack'
+PACK_INDEX_FILENAME = '.packindex'
+_PACK_HEADER = struct.Struct('<4sII')  # magic, rows, cols
+_PACK_SLOT = struct.Struct('<QI')  # offset, length
+_PACK_MAGIC = 'TPK1'
+
+_FORMATS = {
+    '.png': 'PNG',
+    '.jpg': 'JPEG',
+}
+
+# modes where getextrema() gives us the actual colour of every band
+_BLANKABLE_MODES = ('RGB', 'RGBA', 'L', 'CMYK')
+
+# the listings read last, the least recently used first
+_listings_cache = OrderedDict()
+_MAX_LISTINGS = 256
+# the packs and indexes mapped last, the least recently used first. Every
+# mmap keeps a file descriptor open so there can't be too many.
+_mmaps = OrderedDict()
+_MAX_MMAPS = 64
+
+
+def get_single_colour(tile):
+    """return the colour of `tile` if every pixel in it is that colour"""
+    if tile.mode not in _BLANKABLE_MODES:
+        return None
+    extrema = tile.getextrema()
+    if len(tile.getbands()) == 1:
+        extrema = (extrema,)
+    if all(low == high for (low, high) in extrema):
+        return tuple(low for (low, high) in extrema)
+    return None
+
+
+def get_blank_name(mode, colour, extension):
+    return '%s-%s.%s' % (
+        mode.lower(),
+        ''.join('%02x' % x for x in colour),
+        extension
+    )
+
+
+def get_blank_path(static_path, size, name):
+    """return the path to the shared blank tile `name`, making it first
+    if it doesn't exist yet."""
+    path = _get_blank_filepath(static_path, size, name)
+    if not os.path.isfile(path):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+        mode, colour = os.path.splitext(name)[0].split('-')
+        colour = tuple(
+            int(colour[i:i + 2], 16)
+            for i in range(0, len(colour), 2)
+        )
+        if len(colour) == 1:
+            colour = colour[0]
+        blank = Image.new(mode.upper(), (size, size), colour)
+        create_once(path, blank.save)
+    return path
+
+
+def find_blank(static_path, size, name):
+    """return the path to the shared blank tile `name` if it has been
+    made, otherwise None"""
+    path = _get_blank_filepath(static_path, size, name)
+    return os.path.isfile(path) and path or None
+
+
+def _get_blank_filepath(static_path, size, name):
+    return os.path.join(static_path, 'blanks', str(size), name)
+
+
+def get_object_path(static_path, name):
+    return os.path.join(static_path, 'objects', name[:2], name[2:])
+
+
+def _read_listing(directory, filename):
+    path = os.path.join(directory, filename)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    key = (stat.st_mtime, stat.st_size)
+    cached = _listings_cache.pop(path, None)
+    if cached and cached[0] == key:
+        _listings_cache[path] = cached
+        return cached[1]
+    listing = {}
+    for line in open(path):
+        if line.strip():
+            coordinates, name = line.split()
+            listing[coordinates] = name
+    _listings_cache[path] = (key, listing)
+    while len(_listings_cache) > _MAX_LISTINGS:
+        _listings_cache.popitem(last=False)
+    return listing
+
+
+def _append_listing(directory, filename, coordinates, name):
+    # lines are short enough that appends from different workers
+    # don't get mixed up
+    open(os.path.join(directory, filename), 'a').write(
+        '%s %s\n' % (coordinates, name)
+    )
+
+
+def read_blanks(directory):
+    """return a dict of "row,col" -> blank name for a zoom directory"""
+    return _read_listing(directory, BLANKS_FILENAME)
+
+
+def read_index(directory):
+    """return a dict of "row,col" -> object name for a zoom directory"""
+    return _read_listing(directory, INDEX_FILENAME)
+
+
+def _mmap(path):
+    """return a read only mmap of `path`, or None if it's empty or
+    doesn't exist. Don't hang on to it, it's closed once enough other
+    files have been mapped."""
+    cached = _mmaps.pop(path, None)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        stat = None
+    if not stat or not stat.st_size:
+        if cached:
+            cached[1].close()
+        return None
+    key = (stat.st_ino, stat.st_size)
+    if cached and cached[0] == key:
+        # put it back last, i.e. most recently used
+        _mmaps[path] = cached
+        return cached[1]
+    if cached:
+        # it's been replaced or appended to
+        cached[1].close()
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _mmaps[path] = (key, mapped)
+    while len(_mmaps) > _MAX_MMAPS:
+        old_path, (old_key, old) = _mmaps.popitem(last=False)
+        old.close()
+    return mapped
+
+
+def _find_packed(directory, coordinates):
+    index = _mmap(os.path.join(directory, PACK_INDEX_FILENAME))
+    if index is None:
+        return None
+    magic, rows, cols = _PACK_HEADER.unpack_from(index, 0)
+    row, col = [int(x) for x in coordinates.split(',')]
+    if row >= rows or col >= cols:
+        return None
+    offset, length = _PACK_SLOT.unpack_from(
+        index,
+        _PACK_HEADER.size + (col * rows + row) * _PACK_SLOT.size
+    )
+    if not length:
+        return None
+    return offset, length
+
+
+def create_pack(directory, rows, cols):
+    """make an empty pack for a zoom level of `rows` x `cols` tiles"""
+    index_path = os.path.join(directory, PACK_INDEX_FILENAME)
+    header = _PACK_HEADER.pack(_PACK_MAGIC, rows, cols)
+    slots = '\0' * (_PACK_SLOT.size * rows * cols)
+    create_once(index_path, lambda tmp: open(tmp, 'wb').write(header + slots))
+
+
+def prepare_tile_directory(directory, rows, cols):
+    """get the directory of a zoom level ready for `rows` x `cols`
+    tiles"""
+    try:
+        os.makedirs(directory)
+    except OSError as exception:
+        if exception.errno != errno.EEXIST:
+            raise
+    if settings.TILE_STORAGE == 'packed':
+        create_pack(directory, rows, cols)
+
+
+def find_tile(save_filepath, static_path, size):
+    """return the path of the file that has the bytes of the tile that
+    belongs at `save_filepath`, which might be a shared blank tile or an
+    object, or None if the tile hasn't been made or is in a pack."""
+    if os.path.isfile(save_filepath):
+        return save_filepath
+    directory, filename = os.path.split(save_filepath)
+    coordinates = os.path.splitext(filename)[0]
+    name = read_index(directory).get(coordinates)
+    if name:
+        return get_object_path(static_path, name)
+    name = read_blanks(directory).get(coordinates)
+    if name:
+        return get_blank_path(static_path, size, name)
+
+
+def tile_exists(save_filepath):
+    if os.path.isfile(save_filepath):
+        return True
+    directory, filename = os.path.split(save_filepath)
+    coordinates = os.path.splitext(filename)[0]
+    return (
+        coordinates in read_index(directory) or
+        coordinates in read_blanks(directory) or
+        _find_packed(directory, coordinates) is not None
+    )
+
+
+def read_tile(save_filepath, static_path, size):
+    """return the bytes of the tile that belongs at `save_filepath`,
+    wherever they're stored, or None if it hasn't been made."""
+    path = find_tile(save_filepath, static_path, size)
+    if path:
+        return open(path, 'rb').read()
+    directory, filename = os.path.split(save_filepath)
+    packed = _find_packed(directory, os.path.splitext(filename)[0])
+    if packed:
+        offset, length = packed
+        pack = _mmap(os.path.join(directory, PACK_FILENAME))
+        return pack[offset:offset + length]
+
+
+def get_tile_size(save_filepath, static_path, size):
+    """return how many bytes the tile that belongs at `save_filepath` is
+    or None if it hasn't been made."""
+    path = find_tile(save_filepath, static_path, size)
+    if path:
+        return os.stat(path).st_size
+    directory, filename = os.path.split(save_filepath)
+    packed = _find_packed(directory, os.path.splitext(filename)[0])
+    if packed:
+        return packed[1]
+
+
+def get_tile_version(save_filepath, static_path, size):
+    """return (etag, last modified timestamp) for the tile that belongs at
+    `save_filepath` or None if it hasn't been made."""
+    path = find_tile(save_filepath, static_path, size)
+    if path:
+        stat = os.stat(path)
+        return '%x-%x' % (int(stat.st_mtime), stat.st_size), stat.st_mtime
+    directory, filename = os.path.split(save_filepath)
+    packed = _find_packed(directory, os.path.splitext(filename)[0])
+    if packed:
+        # tiles are only ever appended so where it is is what it is
+        stat = os.stat(os.path.join(directory, PACK_FILENAME))
+        return '%x-%x' % packed, stat.st_mtime
+
+
+def save_tile(tile, save_filepath, static_path, size, profile=None):
+    """save `tile` to `save_filepath` unless it's all one colour, in which
+    case it's only recorded as a blank tile, and add it to the image's
+    manifest. `profile` is the encode profile, TILE_ENCODE_PROFILE if
+    it's None.
+
+    Returns the path of the file that should be served for this tile.
+    """
+    path = _store_tile(tile, save_filepath, static_path, size, profile)
+    fileid, zoom, row, col, extension = parse_tile_path(
+        save_filepath,
+        static_path
+    )
+    record_tile(get_redis(), fileid, zoom, row, col, extension,
+                get_tile_size(save_filepath, static_path, size))
+    return path
+
+
+def _store_tile(tile, save_filepath, static_path, size, profile):
+    extension = os.path.splitext(save_filepath)[1]
+    if extension == '.jpg' and tile.mode not in ('RGB', 'L', 'CMYK'):
+        # a PNG original that gets JPEG tiles, it had no use for its alpha
+        tile = tile.convert('RGB')
+    colour = get_single_colour(tile)
+    if colour is None:
+        if settings.TILE_STORAGE == 'cas':
+            return _save_object(tile, save_filepath, static_path, profile)
+        if settings.TILE_STORAGE == 'packed':
+            if _save_packed(tile, save_filepath, profile):
+                return save_filepath
+        return write_atomically(
+            save_filepath,
+            lambda tmp: save_image(tile, tmp, extension, profile)
+        )
+    directory, filename = os.path.split(save_filepath)
+    coordinates, extension = os.path.splitext(filename)
+    name = get_blank_name(tile.mode, colour, extension[1:])
+    path = get_blank_path(static_path, size, name)
+    _append_listing(directory, BLANKS_FILENAME, coordinates, name)
+    return path
+
+
+def _encode(tile, extension, profile):
+    buffer_ = StringIO()
+    save_image(tile, buffer_, extension, profile)
+    return buffer_.getvalue()
+
+
+def save_image(tile, fp, extension, profile=None):
+    """write `tile` to the path or file object `fp` in the format of
+    `extension` ('.png' or '.jpg') the way the encode `profile` says,
+    TILE_ENCODE_PROFILE if it's None"""
+    format = _FORMATS[extension]
+    profile = profile or settings.TILE_ENCODE_PROFILE
+    if profile == 'plain':
+        return tile.save(fp, format)
+    # the way 'plain' saves it is a candidate too, optimize=True picks
+    # other zlib settings and filters that aren't always better
+    encodings = [(tile, {})]
+    if format == 'JPEG':
+        encodings.append((tile, {'optimize': True, 'progressive': True}))
+    else:
+        encodings.append((tile, {'optimize': True}))
+        # a palette isn't always smaller either, the filters do better on
+        # some images with few colours, like gradients
+        palettized = _palettize(tile)
+        if palettized is not None:
+            encodings.append(palettized)
+        elif profile == 'quantized':
+            quantized = quantize_tile(tile)
+            if quantized is not None:
+                encodings.append(quantized)
+    candidates = []
+    for image, options in encodings:
+        if image is not tile:
+            options = dict(options, optimize=True)
+        buffer_ = StringIO()
+        image.save(buffer_, format, **options)
+        candidates.append(buffer_.getvalue())
+    data = min(candidates, key=len)
+    if isinstance(fp, basestring):
+        open(fp, 'wb').write(data)
+    else:
+        fp.write(data)
+
+
+def quantize_tile(tile):
+    """return (palette image, save options) for `tile` reduced to an
+    adaptive palette of TILE_QUANTIZE_COLOURS, or None if that makes it
+    worse than TILE_QUANTIZE_MIN_PSNR.
+
+    Only the colours are quantized. Transparent pixels get a palette
+    entry of their own and RGBA tiles that are partly transparent
+    anywhere aren't quantized at all.
+    """
+    if tile.mode not in ('RGB', 'RGBA'):
+        return None
+    colours = settings.TILE_QUANTIZE_COLOURS
+    alpha = None
+    if tile.mode == 'RGBA':
+        alpha = tile.split()[-1]
+        if alpha.point(lambda x: x not in (0, 255) and 255).getbbox():
+            return None
+        # what's under the transparent pixels doesn't matter and doesn't
+        # get a say in the palette
+        original = Image.new('RGBA', tile.size)
+        original.paste(tile, mask=alpha)
+        colours -= 1
+    else:
+        original = tile
+    rgb = original.convert('RGB')
+    quantized = rgb.quantize(colours)
+    if settings.TILE_QUANTIZE_DITHER:
+        quantized = rgb.quantize(palette=quantized,
+                                 dither=Image.FLOYDSTEINBERG)
+    options = {}
+    if alpha is not None:
+        transparent = max(i for (count, i) in quantized.getcolors(256)) + 1
+        palette = quantized.getpalette()
+        palette[transparent * 3:transparent * 3 + 3] = [0, 0, 0]
+        quantized.putpalette(palette)
+        quantized.paste(transparent, mask=alpha.point(lambda x: 255 - x))
+        quantized.info['transparency'] = options['transparency'] = \
+            transparent
+    if get_psnr(original, quantized.convert(tile.mode)) < \
+            settings.TILE_QUANTIZE_MIN_PSNR:
+        return None
+    options['bits'] = _get_bits(len(quantized.getcolors(256)))
+    return quantized, options
+
+
+def get_psnr(original, other):
+    """peak signal-to-noise ratio, in dB, of `other` compared to
+    `original`. The higher the closer, identical is infinite."""
+    stat = ImageStat.Stat(ImageChops.difference(original, other))
+    count = original.size[0] * original.size[1] * len(stat.sum2)
+    mse = sum(stat.sum2) / count
+    if not mse:
+        return float('inf')
+    return 10 * math.log10(255 ** 2 / mse)
+
+
+def _palettize(tile):
+    """return (palette image, save options) for `tile` if it has few
+    enough colours for that to lose nothing, otherwise None"""
+    if tile.mode not in ('RGB', 'RGBA'):
+        return None
+    colours = tile.getcolors(256)
+    if not colours:
+        return None
+    options = {'bits': _get_bits(len(colours))}
+    if tile.mode == 'RGBA':
+        # quantize() would only do RGBA with the octree method, which
+        # quantizes the alpha too
+        colours = [colour for (count, colour) in colours]
+        indexes = dict((colour, i) for (i, colour) in enumerate(colours))
+        palettized = Image.new('P', tile.size)
+        palettized.putdata([indexes[x] for x in tile.getdata()])
+        palettized.putpalette([x for colour in colours for x in colour[:3]])
+        palettized.info['transparency'] = options['transparency'] = \
+            ''.join(chr(colour[3]) for colour in colours)
+    else:
+        palettized = tile.quantize(len(colours))
+    if palettized.convert(tile.mode).tobytes() != tile.tobytes():
+        return None
+    return palettized, options
+
+
+def _get_bits(colours):
+    """the fewest bits per pixel a PNG palette of `colours` can have"""
+    return [x for x in (1, 2, 4, 8) if 2 ** x >= colours][0]
+
+
+def _save_packed(tile, save_filepath, profile):
+    """append the tile to the pack of its zoom level, if there is one
+    that it fits in, and return True if it did"""
+    directory, filename = os.path.split(save_filepath)
+    coordinates, extension = os.path.splitext(filename)
+    index_path = os.path.join(directory, PACK_INDEX_FILENAME)
+    if not os.path.isfile(index_path):
+        # only the whole zoom levels are packed, the odd tile made by
+        # make_tile() before that is written like any other
+        return False
+    with open(index_path, 'rb') as f:
+        magic, rows, cols = _PACK_HEADER.unpack(f.read(_PACK_HEADER.size))
+    row, col = [int(x) for x in coordinates.split(',')]
+    if row >= rows or col >= cols:
+        return False
+    data = _encode(tile, extension, profile)
+    pack_path = os.path.join(directory, PACK_FILENAME)
+    with path_lock(pack_path):
+        with open(pack_path, 'ab') as f:
+            # appending writes at the end whatever tell() says
+            offset = os.fstat(f.fileno()).st_size
+            f.write(data)
+        with open(index_path, 'r+b') as f:
+            f.seek(_PACK_HEADER.size + (col * rows + row) * _PACK_SLOT.size)
+            f.write(_PACK_SLOT.pack(offset, len(data)))
+    return True
+
+
+def find_all_packed(fileid, static_path, size=256):
+    """yield the path that every tile in a pack would have if it was
+    written to its own file"""
+    image = fileid[:1] + '/' + fileid[1:3] + '/' + fileid[3:]
+    root = os.path.join(static_path, 'tiles', image, str(size))
+    if not os.path.isdir(root):
+        return
+    for zoom in os.listdir(root):
+        directory = os.path.join(root, zoom)
+        index = _mmap(os.path.join(directory, PACK_INDEX_FILENAME))
+        if index is None:
+            continue
+        # a copy, whoever is iterating might map enough other files
+        # meanwhile for this one to be closed
+        index = index[:]
+        extension = None
+        magic, rows, cols = _PACK_HEADER.unpack_from(index, 0)
+        for i in range(rows * cols):
+            offset, length = _PACK_SLOT.unpack_from(
+                index,
+                _PACK_HEADER.size + i * _PACK_SLOT.size
+            )
+            if length:
+                if extension is None:
+                    extension = _guess_extension(directory)
+                yield os.path.join(
+                    directory,
+                    '%s,%s%s' % (i % rows, i / rows, extension)
+                )
+
+
+def _guess_extension(directory):
+    pack = _mmap(os.path.join(directory, PACK_FILENAME))
+    if pack[:4] == '\x89PNG':
+        return '.png'
+    return '.jpg'
+
+
+def _save_object(tile, save_filepath, static_path, profile):
+    """store the tile's bytes under their hash, only once no matter how
+    many tiles of how many images have the same bytes"""
+    directory, filename = os.path.split(save_filepath)
+    coordinates, extension = os.path.splitext(filename)
+    data = _encode(tile, extension, profile)
+    name = hashlib.sha1(data).hexdigest()[:20] + extension
+    path = get_object_path(static_path, name)
+    if not os.path.isfile(path):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+        write_atomically(path, lambda tmp: open(tmp, 'wb').write(data))
+    _append_listing(directory, INDEX_FILENAME, coordinates, name)
+    return path
+
+
+def _find_all_listings(fileid, static_path, filename, size):
+    image = fileid[:1] + '/' + fileid[1:3] + '/' + fileid[3:]
+    root = os.path.join(static_path, 'tiles', image, str(size))
+    all_listings = {}
+    if os.path.isdir(root):
+        for zoom in os.listdir(root):
+            if not zoom.isdigit():
+                continue
+            listing = _read_listing(os.path.join(root, zoom), filename)
+            if listing:
+                all_listings[int(zoom)] = listing
+    return all_listings
+
+
+def find_all_blanks(fileid, static_path, size=256):
+    """return a dict of zoom -> {"row,col": blank name}"""
+    return _find_all_listings(fileid, static_path, BLANKS_FILENAME, size)
+
+
+def find_all_objects(fileid, static_path, size=256):
+    """return a dict of zoom -> {"row,col": object name}"""
+    return _find_all_listings(fileid, static_path, INDEX_FILENAME, size)
+
+
+def find_all_aliases(fileid, static_path, size=256):
+    """return a dict of zoom -> {"row,col": URL} for all the tiles that
+    are shared blanks. Objects aren't in it, there's one for nearly every
+    tile and TileHandler finds them from the tile's own URL."""
+    aliases = {}
+    all_blanks = find_all_blanks(fileid, static_path, size)
+    for zoom, blanks in all_blanks.items():
+        aliases[zoom] = dict(
+            (coordinates, '/blanks/%s/%s' % (size, name))
+            for (coordinates, name) in blanks.items()
+        )
+    return aliases
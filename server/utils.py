@@ -1,10 +1,23 @@
 import time
+import errno
 import shutil
 import os
 import stat
+import subprocess
+import multiprocessing
 from PIL import Image
 import logging
-from resizer import make_resize, resize_image
+from resizer import make_resize, make_resizes, resize_image
+from imagecache import ImageCache
+from atomicfile import create_once, path_lock, is_hidden
+from tilestore import (
+    save_tile, tile_exists, find_tile, find_all_objects,
+    find_all_packed, get_object_path, prepare_tile_directory, read_blanks,
+    read_index, get_tile_size
+)
+import manifest
+from jobs import notify
+import settings
 
 
 def mkdir(newdir):
@@ -22,23 +35,22 @@ def mkdir(newdir):
     if head and not os.path.isdir(head):
         mkdir(head)
     if tail:
-        os.mkdir(newdir)
+        try:
+            os.mkdir(newdir)
+        except OSError as exception:
+            # another queue worker might have just made it
+            if exception.errno != errno.EEXIST:
+                raise
 
 
-_RESIZES = {}
-_TIMESTAMPS = {}
+# decoded resize levels shared by make_tile(), make_tiles() and thumbnails
+_RESIZES = ImageCache(settings.RESIZE_CACHE_MAX_BYTES)
+
 
 def scale_and_crop(path, requested_size, row, col, zoom, image,
                    cache_image_open=False):
-    im = Image.open(path)
-    x, y = [float(v) for v in im.size]
-    xr, yr = [float(v) for v in requested_size]
-    r = min(xr / x, yr / y)
-
     box = (256 * row, 256 * col, 256 * (row + 1), 256 * (col + 1))
 
-    w, h = int(round(x * r)), int(round(y * r))
-    _cache_key = '%s-%s-%s' % (image, zoom, w)
     pathname, extension = os.path.splitext(path)
 
     width = 256 * (2 ** zoom)
@@ -55,27 +67,9 @@ def scale_and_crop(path, requested_size, row, col, zoom, image,
         _resized_file = make_resize(path, zoom)
         t1 = time.time()
         print "\ttook", round(t1 - t0, 2), "seconds"
-        time.sleep(0.5)  # time to save it
-
 
     if cache_image_open:
-        if _cache_key in _RESIZES:
-            im = _RESIZES[_cache_key]
-        else:
-            im = Image.open(_resized_file)
-            print "Having to use Image.open()"
-            _RESIZES[_cache_key] = im
-            _TIMESTAMPS[_cache_key] = time.time()
-
-        # to avoid memory bloat of `_RESIZES` getting too large, instead use the
-        # `_TIMESTAMPS` dict to keep track of which Image instances are getting old
-        _now = time.time()
-        for key, timestamp in _TIMESTAMPS.items():
-            age = _now - timestamp
-            if age > 10:
-                print "CLEAR", key
-                del _TIMESTAMPS[key]
-                del _RESIZES[key]
+        im = _RESIZES.open(_resized_file)
     else:
         im = Image.open(_resized_file)
 
@@ -92,7 +86,7 @@ def make_thumbnail(*args, **kwargs):  # wrapper on _make_thumbnail()
 
 
 def _make_thumbnail(image, width, extension, static_path,
-                    raise_error_if_not_found=False):
+                    raise_error_if_not_found=False, resize_engine=None):
     root = os.path.join(
         static_path,
         'uploads'
@@ -113,7 +107,7 @@ def _make_thumbnail(image, width, extension, static_path,
     candidates = [
         os.path.join(root, x)
         for x in os.listdir(root)
-        if _filename in x
+        if _filename in x and not is_hidden(x)
     ]
     if not candidates:
         if raise_error_if_not_found:
@@ -137,36 +131,30 @@ def _make_thumbnail(image, width, extension, static_path,
         save_filepath,
         '%s.%s' % (width, extension)
     )
-    if not os.path.isfile(save_filepath):
-        thumbnail_image = _resize_thumbnail(
-            path,
-            width,
-            save_filepath,
-        )
-        if thumbnail_image is not None:
-            #print "Created", save_filepath
-            thumbnail_image.save(save_filepath)
+    create_once(
+        save_filepath,
+        lambda tmp: _resize_thumbnail(path, width, tmp,
+                                      resize_engine=resize_engine)
+    )
 
     return save_filepath
 
 
-def _resize_thumbnail(path, width, save_filepath):
+def _resize_thumbnail(path, width, save_filepath, resize_engine=None):
     t0 = time.time()
     im = Image.open(path)
     x, y = [float(v) for v in im.size]
     xr, yr = [float(v) for v in (width, width)]
     r = min(xr / x, yr / y)
     w, h = int(round(x * r)), int(round(y * r))
-    resize_image(path, w, save_filepath)
-    #im = im.resize((w, h),
-    #               resample=Image.ANTIALIAS)
+    resize_image(path, w, save_filepath, engine=resize_engine)
     t1 = time.time()
     print "Took", round(t1 - t0, 2), "seconds to resize thumbnail", path
-    return Image.open(save_filepath)
+    return save_filepath
 
 
 def make_tile(image, size, zoom, row, col, extension, static_path,
-              cache_image_open=False):
+              cache_image_open=False, profile=None):
 
     size = int(size)
     zoom = int(zoom)
@@ -179,14 +167,12 @@ def make_tile(image, size, zoom, row, col, extension, static_path,
         static_path,
         'uploads'
     )
-    if not os.path.isdir(root):
-        os.mkdir(root)
+    mkdir(root)
     save_root = os.path.join(
         static_path,
         'tiles'
     )
-    if not os.path.isdir(save_root):
-        os.mkdir(save_root)
+    mkdir(save_root)
     path = os.path.join(root, image)
     for i in ('.png', '.jpg'):
         path = os.path.join(root, image + i)
@@ -195,24 +181,25 @@ def make_tile(image, size, zoom, row, col, extension, static_path,
     else:
         raise IOError(image)
 
-    save_filepath = save_root
-    for p in (image, str(size), str(zoom)):
-        save_filepath = os.path.join(save_filepath, p)
-        if not os.path.isdir(save_filepath):
-            try:
-                mkdir(save_filepath)
-            except OSError:
-                # because this function is called concurrently by the queue
-                # workers this is not thread safe so it might raise an OSError
-                # even though the file already exists
-                time.sleep(0.1)
-                if not os.path.isdir(save_filepath):
-                    raise
+    save_filepath = os.path.join(save_root, image, str(size), str(zoom))
+    mkdir(save_filepath)
     save_filepath = os.path.join(
         save_filepath,
         '%s,%s.%s' % (row, col, extension)
     )
-    if not os.path.isfile(save_filepath):
+    if os.path.isfile(save_filepath):
+        return save_filepath
+    stored_filepath = find_tile(save_filepath, static_path, size)
+    if stored_filepath:
+        return stored_filepath
+    if tile_exists(save_filepath):
+        # it's in a pack, use read_tile() to get its bytes
+        return save_filepath
+
+    # if another worker is already making it, this waits for that
+    with path_lock(save_filepath):
+        if tile_exists(save_filepath):
+            return save_filepath
         #print "From", image, "make", '%s,%s.%s' % (row, col, extension)
         width = size * (2 ** zoom)
         cropped_image = scale_and_crop(
@@ -223,20 +210,321 @@ def make_tile(image, size, zoom, row, col, extension, static_path,
             image=image,
             cache_image_open=cache_image_open
         )
-        if cropped_image is not None:
-            #print "Created", save_filepath
-            cropped_image.save(save_filepath)
+        return save_tile(cropped_image, save_filepath, static_path, size,
+                         profile=profile)
+
+
+def make_tile_batch(image, size, zoom, tiles, extension, static_path,
+                    profile=None):
+    """make every tile in `tiles`, a list of (row, col, channel), from one
+    open image and tell the channel of each as soon as it's made."""
+    t0 = time.time()
+    for row, col, channel in tiles:
+        try:
+            make_tile(image, size, zoom, row, col, extension, static_path,
+                      cache_image_open=True, profile=profile)
+        except Exception:
+            logging.error("Unable to make tile %s,%s for %s at %s" %
+                          (row, col, image, zoom), exc_info=True)
+            notify(channel, 'failed')
+        else:
+            notify(channel, 'done')
+    t1 = time.time()
+    print "Took", round(t1 - t0, 2), "seconds to make a batch of",
+    print len(tiles), "tiles for", image, "zoom", zoom
 
-    return save_filepath
 
+def make_neighbourhood(image, size, zoom, row, col, extension, static_path,
+                       grids, radius=1, children=False, profile=None):
+    """make the tiles around row,col at `zoom`, nearest first, and the four
+    under it at the next zoom level if `children`, opening the resized
+    image of each zoom level only once.
 
-def make_tiles(image, size, zoom, rows, cols, extension, static_path):
+    `grids` is a dict of zoom -> (rows, cols) of the zoom levels that can
+    be made, as returned by get_tile_grid().
+    """
+    zoom = int(zoom)
+    row = int(row)
+    col = int(col)
+    coordinates = []
+    rows, cols = grids[zoom]
+    around = [
+        (max(abs(r - row), abs(c - col)), r, c)
+        for r in range(max(0, row - radius), min(rows, row + radius + 1))
+        for c in range(max(0, col - radius), min(cols, col + radius + 1))
+        if (r, c) != (row, col)
+    ]
+    around.sort()
+    coordinates.extend((zoom, r, c) for (distance, r, c) in around)
+    if children and zoom + 1 in grids:
+        rows, cols = grids[zoom + 1]
+        for r in (row * 2, row * 2 + 1):
+            for c in (col * 2, col * 2 + 1):
+                if r < rows and c < cols:
+                    coordinates.append((zoom + 1, r, c))
+
+    t0 = time.time()
+    for z, r, c in coordinates:
+        make_tile(image, size, z, r, c, extension, static_path,
+                  cache_image_open=True, profile=profile)
+    t1 = time.time()
+    print "Took", round(t1 - t0, 2), "seconds to prefetch",
+    print len(coordinates), "tiles around", image, zoom, row, col
+
+
+def get_tile_grid(width, height, zoom, size=256):
+    """return how many (rows, cols) of tiles there are at `zoom` for an
+    image of `width` x `height`.
+
+    Like the URLs, a "row" is a tile's x position and a "col" its y
+    position. Every zoom level is resized to be `size * 2 ** zoom` wide.
+    """
+    zoom_width = size * (2 ** zoom)
+    zoom_height = int(round(float(height) * zoom_width / width))
+    rows = (zoom_width + size - 1) / size
+    cols = max(1, (zoom_height + size - 1) / size)
+    return rows, cols
+
+
+def make_tiles(image, size, zoom, rows, cols, extension, static_path,
+               memory_budget=None, processes=None, profile=None,
+               cascade=None, resize_engine=None):
+    if cascade:
+        # the resize for this zoom level is made from the one above it,
+        # and so on up to the original, by whichever job gets to each
+        # one first while the others wait for it
+        _make_cascade(image, static_path, list(cascade) + [zoom],
+                      memory_budget, resize_engine)
+    if memory_budget:
+        return _make_tiles_in_strips(image, size, zoom, rows, cols,
+                                     extension, static_path, memory_budget,
+                                     profile=profile)
+    if processes is not None:
+        return _make_tiles_in_parallel(image, size, zoom, rows, cols,
+                                       extension, static_path, processes,
+                                       profile=profile)
+    prepare_tile_directory(
+        os.path.join(static_path, 'tiles', image, str(size), str(zoom)),
+        rows, cols
+    )
     # this is an "optimization" over make_tile() since we make one Image
     # instance and re-use it for every row and every column.
-    for row in range(rows + 1):
-        for col in range(cols + 1):
+    for row in range(rows):
+        for col in range(cols):
             make_tile(image, size, zoom, row, col, extension, static_path,
-                      cache_image_open=True)
+                      cache_image_open=True, profile=profile)
+    print "Resize cache:", _RESIZES.stats()
+
+
+def _make_cascade(image, static_path, zooms, memory_budget, resize_engine):
+    root = os.path.join(
+        static_path,
+        'uploads'
+    )
+    for i in ('.png', '.jpg'):
+        path = os.path.join(root, image + i)
+        if os.path.isfile(path):
+            break
+    else:
+        raise IOError(image)
+    make_resizes(path, zooms, engine=resize_engine, cascade=True,
+                 memory_limit=memory_budget)
+
+
+def _make_tiles_in_strips(image, size, zoom, rows, cols, extension,
+                          static_path, memory_budget, profile=None):
+    """like make_tiles() but never holds more than `memory_budget` bytes
+    of pixels in memory.
+
+    The resized image is read in horizontal strips that are a multiple of
+    `size` pixels high, using ImageMagick's `stream` which only decodes
+    the pixels it's asked for, and every tile in a strip is made before
+    the next strip is read.
+    """
+    size = int(size)
+    zoom = int(zoom)
+    assert size == 256, size
+
+    root = os.path.join(
+        static_path,
+        'uploads'
+    )
+    for i in ('.png', '.jpg'):
+        path = os.path.join(root, image + i)
+        if os.path.isfile(path):
+            break
+    else:
+        raise IOError(image)
+    _resized_file = make_resize(path, zoom, memory_limit=memory_budget)
+
+    save_root = os.path.join(
+        static_path,
+        'tiles',
+        image,
+        str(size),
+        str(zoom)
+    )
+    prepare_tile_directory(save_root, rows, cols)
+
+    im = Image.open(_resized_file)  # only reads the header
+    width, height = im.size
+    if 'A' in im.mode or 'transparency' in im.info:
+        mode, pixel_map = 'RGBA', 'rgba'
+    else:
+        mode, pixel_map = 'RGB', 'rgb'
+    del im
+    # the tiles are cropped straight from what `stream` gives us, which
+    # for a moment is there twice, as its output and as PIL's copy of it
+    # with 4 bytes for every pixel
+    k = max(1, memory_budget / (width * (len(pixel_map) + 4) * size))
+    print "Making tiles in strips of", k * size, "pixels"
+
+    t0 = time.time()
+    for top in range(0, cols, k):
+        strip_cols = range(top, min(top + k, cols))
+        save_filepaths = {}
+        for row in range(rows):
+            for col in strip_cols:
+                save_filepath = os.path.join(
+                    save_root,
+                    '%s,%s.%s' % (row, col, extension)
+                )
+                if not tile_exists(save_filepath):
+                    save_filepaths[(row, col)] = save_filepath
+        if not save_filepaths:
+            continue
+
+        y = top * size
+        strip_height = min(height - y, size * len(strip_cols))
+        if strip_height > 0:
+            strip = _read_strip(_resized_file, width, strip_height, y,
+                                mode, pixel_map)
+        else:
+            strip = Image.new(mode, (size, size))
+        # cropping beyond the edges of the strip pads the tiles on the
+        # right and at the bottom with 0s, like a blank strip would
+        for (row, col), save_filepath in save_filepaths.items():
+            box = (
+                size * row,
+                size * (col - top),
+                size * (row + 1),
+                size * (col - top + 1)
+            )
+            save_tile(strip.crop(box), save_filepath, static_path, size,
+                      profile=profile)
+        del strip
+    t1 = time.time()
+    print "Took", round(t1 - t0, 2), "seconds to make strip tiles for", image
+
+
+def _read_strip(path, width, height, y, mode, pixel_map):
+    cmd = (
+        'stream -map %s -storage-type char -extract %dx%d+0+%d %s -' %
+        (pixel_map, width, height, y, path)
+    )
+    process = subprocess.Popen(
+        cmd,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    out, err = process.communicate()
+    if len(out) != width * height * len(pixel_map):
+        raise IOError("stream: %s" % err)
+    return Image.frombuffer(mode, (width, height), out, 'raw', mode, 0, 1)
+
+
+# the decoded image that the pool workers in _make_tiles_in_parallel()
+# inherit when they're forked
+_POOL_IMAGE = None
+
+
+def _make_tiles_in_parallel(image, size, zoom, rows, cols, extension,
+                            static_path, processes, profile=None):
+    """like make_tiles() but splits the rows over a pool of processes.
+
+    The resized image is decoded once, before the pool is started, so
+    every forked worker gets it for free and only has to crop and encode.
+    `processes` of 0 means one per CPU.
+    """
+    global _POOL_IMAGE
+    size = int(size)
+    zoom = int(zoom)
+    assert size == 256, size
+
+    root = os.path.join(
+        static_path,
+        'uploads'
+    )
+    for i in ('.png', '.jpg'):
+        path = os.path.join(root, image + i)
+        if os.path.isfile(path):
+            break
+    else:
+        raise IOError(image)
+
+    save_root = os.path.join(
+        static_path,
+        'tiles',
+        image,
+        str(size),
+        str(zoom)
+    )
+    prepare_tile_directory(save_root, rows, cols)
+
+    processes = processes or multiprocessing.cpu_count()
+    chunk = (rows + processes - 1) / processes  # rounded up
+    row_ranges = [
+        (first, min(first + chunk, rows))
+        for first in range(0, rows, chunk)
+    ]
+
+    t0 = time.time()
+    _POOL_IMAGE = _RESIZES.open(make_resize(path, zoom))
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(
+            _make_tiles_for_rows,
+            [(first, last, cols, size, extension, save_root, static_path,
+              profile)
+             for (first, last) in row_ranges]
+        )
+    finally:
+        pool.close()
+        pool.join()
+        _POOL_IMAGE = None
+    t1 = time.time()
+
+    per_worker = {}
+    for pid, count, seconds in results:
+        done = per_worker.get(pid, (0, 0.0))
+        per_worker[pid] = (done[0] + count, done[1] + seconds)
+    for pid, (count, seconds) in sorted(per_worker.items()):
+        print "\tworker %s made %d tiles in %s seconds (%.1f tiles/s)" % (
+            pid, count, round(seconds, 2), count / max(seconds, 0.001)
+        )
+    print "Took", round(t1 - t0, 2), "seconds to make tiles for", image,
+    print "zoom", zoom, "with", len(per_worker), "workers"
+
+
+def _make_tiles_for_rows(args):
+    (first, last, cols, size, extension, save_root, static_path,
+     profile) = args
+    t0 = time.time()
+    count = 0
+    for row in range(first, last):
+        for col in range(cols):
+            save_filepath = os.path.join(
+                save_root,
+                '%s,%s.%s' % (row, col, extension)
+            )
+            if not tile_exists(save_filepath):
+                box = (size * row, size * col,
+                       size * (row + 1), size * (col + 1))
+                save_tile(_POOL_IMAGE.crop(box), save_filepath,
+                          static_path, size, profile=profile)
+                count += 1
+    return os.getpid(), count, time.time() - t0
 
 
 def delete_image(image, static_path):
@@ -265,6 +553,8 @@ def delete_image(image, static_path):
         dir_ = os.path.join(root, image)
         shutil.rmtree(dir_)
 
+    manifest.clear(manifest.get_redis(), image.replace('/', ''))
+
 
 def find_original(fileid, static_path, extension):
     image = fileid[:1] + '/' + fileid[1:3] + '/' + fileid[3:]
@@ -276,11 +566,65 @@ def find_original(fileid, static_path, extension):
     return os.path.isfile(path) and path or None
 
 
-def count_all_tiles(fileid, static_path):
-    return len(list(find_all_tiles(fileid, static_path)))
+def rebuild_manifest(fileid, static_path):
+    """make the manifest of an image from what's on disk, for images
+    whose tiles were made before there were manifests"""
+    redis_ = manifest.get_redis()
+    manifest.clear(redis_, fileid)
+    image = fileid[:1] + '/' + fileid[1:3] + '/' + fileid[3:]
+    root = os.path.join(static_path, 'tiles', image, '256')
+    count = 0
+    if not os.path.isdir(root):
+        # so that it isn't rebuilt again and again
+        manifest.mark_rebuilt(redis_, fileid)
+        return count
+    packed = set(find_all_packed(fileid, static_path))
+    for zoom in os.listdir(root):
+        directory = os.path.join(root, zoom)
+        if not zoom.isdigit() or not os.path.isdir(directory):
+            continue
+        names = set(
+            f for f in os.listdir(directory)
+            if not is_hidden(f)
+        )
+        names.update(
+            os.path.basename(each) for each in packed
+            if os.path.dirname(each) == directory
+        )
+        for coordinates, name in read_blanks(directory).items():
+            names.add(coordinates + os.path.splitext(name)[1])
+        # objects are named by their hash and the tile's extension
+        for coordinates, name in read_index(directory).items():
+            names.add(coordinates + os.path.splitext(name)[1])
+        for name in names:
+            coordinates, extension = os.path.splitext(name)
+            row, col = [int(x) for x in coordinates.split(',')]
+            manifest.record_tile(
+                redis_, fileid, int(zoom), row, col, extension[1:],
+                get_tile_size(os.path.join(directory, name),
+                              static_path, 256) or 0
+            )
+            count += 1
+    manifest.mark_rebuilt(redis_, fileid)
+    return count
 
 
 def find_all_tiles(fileid, static_path):
+    """yield the path of every file that has the bytes of a tile of this
+    image except for shared blanks, and the path of every packed tile"""
+    for each in _find_tile_files(fileid, static_path):
+        yield each
+    names = set()
+    for objects in find_all_objects(fileid, static_path).values():
+        names.update(objects.values())
+    for name in names:
+        yield get_object_path(static_path, name)
+    # these aren't files, see tilestore.read_tile()
+    for each in find_all_packed(fileid, static_path):
+        yield each
+
+
+def _find_tile_files(fileid, static_path):
     image = fileid[:1] + '/' + fileid[1:3] + '/' + fileid[3:]
     tiles_root = os.path.join(
         static_path,
@@ -291,7 +635,9 @@ def find_all_tiles(fileid, static_path):
         here = []
         for f in os.listdir(in_):
             p = os.path.join(in_, f)
-            if os.path.isdir(p):
+            if is_hidden(p):
+                continue
+            elif os.path.isdir(p):
                 here.extend(walk(p))
             elif os.path.isfile(p):
                 here.append(p)